@@ -0,0 +1,156 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compare OPA request latency over TCP and over a unix domain socket
+
+A local stand-in server answers rpe/evaluate with a fixed result, and
+rpe/policies with a single policy, so the numbers reflect transport
+overhead rather than policy evaluation time.
+
+    python -m benchmarks.opa_transport [--requests N]
+'''
+
+import argparse
+import json
+import os
+import socketserver
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+from rpe.engines import OpenPolicyAgent
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    body = json.dumps({'result': [{
+        'policy_id': 'bucket_versioning',
+        'compliant': True,
+        'excluded': False,
+        'remediable': False,
+    }]}).encode('utf-8')
+
+    # The engine fetches the policy catalog before its first evaluation
+    policies_body = json.dumps({'result': [{
+        'policy_id': 'bucket_versioning',
+        'applies_to': ['storage.googleapis.com/Bucket'],
+        'description': 'Require versioning',
+    }]}).encode('utf-8')
+
+    def do_GET(self):
+        if self.path.endswith('/rpe/policies'):
+            self._respond(self.policies_body)
+        else:
+            self._respond(b'{"result": {}}')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._respond(self.body)
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TcpStandInHandler(StandInHandler):
+    disable_nagle_algorithm = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class BenchResource:
+
+    def get(self):
+        return {
+            'type': 'storage.googleapis.com/Bucket',
+            'name': '//storage.googleapis.com/my-bucket',
+            'resource': {'versioning': {'enabled': True}, 'labels': {}},
+            'iam': {'bindings': []},
+        }
+
+    def type(self):
+        return 'storage.googleapis.com/Bucket'
+
+
+def run(opa, requests):
+    resource = BenchResource()
+
+    # Warm up the connection pool
+    opa.evaluate(resource)
+
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        opa.evaluate(resource)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print('{:<5} mean {:8.1f}us  p50 {:8.1f}us  p99 {:8.1f}us'.format(
+        name,
+        statistics.mean(timings) * 1e6,
+        timings[len(timings) // 2] * 1e6,
+        timings[int(len(timings) * 0.99)] * 1e6,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        socket_path = os.path.join(tmpdir, 'opa.sock')
+
+        servers = [
+            ThreadingHTTPServer(('127.0.0.1', 0), TcpStandInHandler),
+            ThreadingUnixHTTPServer(socket_path, StandInHandler),
+        ]
+        for server in servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        host, port = servers[0].server_address
+        engines = [
+            ('tcp', OpenPolicyAgent('http://{}:{}/v1/data'.format(host, port))),
+            ('uds', OpenPolicyAgent('unix://{}/v1/data'.format(quote(socket_path, safe='')))),
+        ]
+
+        for name, opa in engines:
+            report(name, run(opa, args.requests))
+            opa.close()
+
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,8 @@ description = "Disallow the use of debug mode on AppEngine Flex instances"
 
 applies_to = ["appengine.googleapis.com/Instance"]
 
+components = []
+
 #####
 # Resource metadata
 #####
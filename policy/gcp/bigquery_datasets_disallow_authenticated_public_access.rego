@@ -22,6 +22,8 @@ description = "Disallow authenticated public access to bigquery datasets"
 
 applies_to = ["bigquery.googleapis.com/Dataset"]
 
+components = []
+
 #####
 # Resource metadata
 #####
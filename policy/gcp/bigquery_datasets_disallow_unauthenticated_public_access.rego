@@ -22,6 +22,8 @@ description = "Disallow unauthenticated public access to bigquery datasets"
 
 applies_to = ["bigquery.googleapis.com/Dataset"]
 
+components = []
+
 #####
 # Resource metadata
 #####
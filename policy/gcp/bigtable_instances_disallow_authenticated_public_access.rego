@@ -22,6 +22,8 @@ description = "Disallow authenticated public access to bigtable instances"
 
 applies_to = ["bigtableadmin.googleapis.com/Instance"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
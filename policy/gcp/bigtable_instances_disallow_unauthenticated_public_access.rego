@@ -22,6 +22,8 @@ description = "Disallow unauthenticated public access to bigtable instances"
 
 applies_to = ["bigtableadmin.googleapis.com/Instance"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
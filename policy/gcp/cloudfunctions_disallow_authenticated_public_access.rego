@@ -22,6 +22,8 @@ description = "Disallow authenticated public access for invoking cloud functions
 
 applies_to = ["cloudfunctions.googleapis.com/CloudFunction"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
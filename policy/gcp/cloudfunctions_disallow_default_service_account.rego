@@ -22,6 +22,8 @@ description = "Disallow the use of the default service account for running cloud
 
 applies_to = ["cloudfunctions.googleapis.com/CloudFunction"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Disallow unauthenticated public access for invoking cloud functio
 
 applies_to = ["cloudfunctions.googleapis.com/CloudFunction"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
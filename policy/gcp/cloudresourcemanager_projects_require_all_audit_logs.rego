@@ -22,6 +22,8 @@ description = "Require that all audit logs are enabled on a project"
 
 applies_to = ["cloudresourcemanager.googleapis.com/Project"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
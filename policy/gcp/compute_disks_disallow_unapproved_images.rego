@@ -22,6 +22,8 @@ description = "Disallow use of unapproved images for compute disks"
 
 applies_to = ["compute.googleapis.com/Disk"]
 
+components = []
+
 #####
 # Resource metadata
 #####
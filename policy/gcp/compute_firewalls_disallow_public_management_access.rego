@@ -24,6 +24,8 @@ description = "Disallow public management access in firewall rules"
 
 applies_to = ["compute.googleapis.com/Firewall"]
 
+components = []
+
 #####
 # Resource metadata
 #####
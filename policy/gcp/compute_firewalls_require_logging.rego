@@ -24,6 +24,8 @@ description = "Require logging for firewall rules"
 
 applies_to = ["compute.googleapis.com/Firewall"]
 
+components = []
+
 #####
 # Resource metadata
 #####
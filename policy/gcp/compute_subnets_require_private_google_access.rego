@@ -24,6 +24,8 @@ description = "Require private google access for subnetworks"
 
 applies_to = ["compute.googleapis.com/Subnetwork"]
 
+components = []
+
 #####
 # Resource metadata
 #####
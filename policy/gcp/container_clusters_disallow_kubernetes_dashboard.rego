@@ -22,6 +22,8 @@ description = "Disallow the use of the kubernetes dashboard"
 
 applies_to = ["container.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
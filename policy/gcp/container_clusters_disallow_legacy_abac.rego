@@ -22,6 +22,8 @@ description = "Disallow the use of legacy abac for GKE clusters"
 
 applies_to = ["container.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
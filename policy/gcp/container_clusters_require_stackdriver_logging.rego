@@ -22,6 +22,8 @@ description = "Require stackdriver logging for GKE clusters"
 
 applies_to = ["container.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Require stackdriver monitoring for GKE clusters"
 
 applies_to = ["container.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Require that nodepools have auto-upgrade and auto-repair enabled"
 
 applies_to = ["container.googleapis.com/NodePool"]
 
+components = []
+
 #####
 # Resource metadata
 #####
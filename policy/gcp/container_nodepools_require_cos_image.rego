@@ -22,6 +22,8 @@ description = "Require nodepools to use the Container-Optimized OS images"
 
 applies_to = ["container.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
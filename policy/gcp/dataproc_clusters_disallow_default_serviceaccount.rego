@@ -22,6 +22,8 @@ description = "Disallow running a dataproc cluster as the default service accoun
 
 applies_to = ["dataproc.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Disallow extended use of dataproc cluster"
 
 applies_to = ["dataproc.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Require SSL for connectivity to SQL instances"
 
 applies_to = ["dataproc.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
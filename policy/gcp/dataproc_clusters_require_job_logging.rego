@@ -22,6 +22,8 @@ description = "Require dataproc cluster job logging"
 
 applies_to = ["dataproc.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Require kerberos to ensure traffic between cluster nodes is encry
 
 applies_to = ["dataproc.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Require yarn logging for dataproc clusters"
 
 applies_to = ["dataproc.googleapis.com/Cluster"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Disallow unauthenticated public access for Pub/Sub subscriptions"
 
 applies_to = ["pubsub.googleapis.com/Subscription"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Disallow authenticated public access for Pub/Sub topics"
 
 applies_to = ["pubsub.googleapis.com/Topic"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Disallow public network access to SQL instances"
 
 applies_to = ["sqladmin.googleapis.com/Instance"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Require scheduled backups for SQL instances"
 
 applies_to = ["sqladmin.googleapis.com/Instance"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -22,6 +22,8 @@ description = "Require SSL for connectivity to SQL instances"
 
 applies_to = ["sqladmin.googleapis.com/Instance"]
 
+components = []
+
 #####
 # Resource metadata
 #####
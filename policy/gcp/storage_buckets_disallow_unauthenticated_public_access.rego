@@ -22,6 +22,8 @@ description = "Disallow IAM policy for unauthenticated users"
 
 applies_to = ["storage.googleapis.com/Bucket"]
 
+components = ["iam"]
+
 #####
 # Resource metadata
 #####
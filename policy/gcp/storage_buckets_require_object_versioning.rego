@@ -22,6 +22,8 @@ description = "Require object versioning for storage buckets"
 
 applies_to = ["storage.googleapis.com/Bucket"]
 
+components = []
+
 #####
 # Resource metadata
 #####
@@ -20,6 +20,7 @@ policies = [{
 	"policy_id": name,
 	"description": object.get(p, "description", ""),
 	"applies_to": p.applies_to,
+	"components": object.get(p, "components", null),
 } |
 	p = data.rpe.policy[name]
 ]
@@ -33,7 +34,27 @@ evaluate = [{
 	name := matched_policies[_]
 ]
 
+# Evaluate many resources in a single request. Expects an input of the form
+# {"resources": [<resource>, ...]} and returns one list of evaluations per
+# resource, in the same order as the input
+evaluate_batch = [evals |
+	some i
+	resource := input.resources[i]
+	evals := evaluate with input as resource
+]
+
 matched_policies = sort([name |
 	p = data.rpe.policy[name]
-	input.type == p.applies_to[_]
+	applies(p.applies_to[_])
 ])
+
+# applies_to entries are exact resource types, '*' for all types, or a prefix
+# ending with '*', like the python engine's PolicyIndex
+applies(pattern) {
+	pattern == input.type
+}
+
+applies(pattern) {
+	endswith(pattern, "*")
+	startswith(input.type, trim_suffix(pattern, "*"))
+}
@@ -0,0 +1,70 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+package rpe
+
+mock_policies = {
+	"bucket_policy": {
+		"applies_to": ["storage.googleapis.com/Bucket"],
+		"components": ["iam"],
+		"compliant": true,
+		"excluded": false,
+	},
+	"project_policy": {
+		"applies_to": ["cloudresourcemanager.googleapis.com/Project"],
+		"compliant": false,
+		"excluded": false,
+	},
+}
+
+test_evaluate_batch_preserves_order {
+	results := evaluate_batch with data.rpe.policy as mock_policies
+		 with input as {"resources": [
+			{"type": "cloudresourcemanager.googleapis.com/Project"},
+			{"type": "unknown.googleapis.com/Widget"},
+			{"type": "storage.googleapis.com/Bucket"},
+		]}
+
+	count(results) == 3
+	results[0][0].policy_id == "project_policy"
+	results[0][0].compliant == false
+	count(results[1]) == 0
+	results[2][0].policy_id == "bucket_policy"
+	results[2][0].compliant == true
+}
+
+test_evaluate_batch_empty {
+	count(evaluate_batch) == 0 with input as {"resources": []}
+}
+
+test_policies_components {
+	results := policies with data.rpe.policy as mock_policies
+
+	count(results) == 2
+	results[i].policy_id == "bucket_policy"
+	results[i].components == ["iam"]
+	results[j].policy_id == "project_policy"
+	results[j].components == null
+}
+
+test_evaluate_wildcards {
+	results := evaluate with data.rpe.policy as {
+		"all": {"applies_to": ["*"]},
+		"compute": {"applies_to": ["compute.googleapis.com/*"]},
+		"bucket": {"applies_to": ["storage.googleapis.com/Bucket"]},
+	}
+		 with input as {"type": "compute.googleapis.com/Instance"}
+
+	[r.policy_id | r := results[_]] == ["all", "compute"]
+}
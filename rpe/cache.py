@@ -0,0 +1,160 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+''' Key/value caches with LRU and TTL eviction '''
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    ''' A thread-safe in-memory cache
+
+    Values are stored as given, so must not be modified after they're set.
+    '''
+
+    def __init__(self, maxsize=10000, ttl=None):
+        '''
+        Args:
+            maxsize: The most entries to keep, least recently used ones are evicted first
+            ttl: Default number of seconds entries are kept for, None keeps them until evicted
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns:
+            The cached value, or None if there isn't one or it expired
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteCache:
+    ''' A thread-safe cache stored in a SQLite database, which persists between processes
+
+    Values must be JSON-serializable.
+    '''
+
+    def __init__(self, path, maxsize=None, ttl=None, table='cache'):
+        '''
+        Args:
+            path: Path of the database file, created if it doesn't exist
+            maxsize: The most entries to keep, least recently used ones are evicted first
+            ttl: Default number of seconds entries are kept for, None keeps them until evicted
+            table: Name of the table to store entries in, so caches can share a database
+        '''
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.table = table
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            f'CREATE TABLE IF NOT EXISTS {table} '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, used REAL NOT NULL)'
+        )
+        self._db.execute(f'CREATE INDEX IF NOT EXISTS {table}_used ON {table} (used)')
+
+    def get(self, key):
+        '''
+        Returns:
+            The cached value, or None if there isn't one or it expired
+        '''
+        now = time.time()
+
+        with self._lock:
+            row = self._db.execute(
+                f'SELECT value, expires FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, expires = row
+            if expires is not None and expires <= now:
+                self._db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return None
+
+            if self.maxsize is not None:
+                self._db.execute(f'UPDATE {self.table} SET used = ? WHERE key = ?', (now, key))
+
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        value = json.dumps(value, separators=(',', ':'))
+
+        with self._lock:
+            self._db.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, expires, used) VALUES (?, ?, ?, ?)',
+                (key, value, expires, now)
+            )
+
+            if self.maxsize is not None:
+                self._db.execute(
+                    f'DELETE FROM {self.table} WHERE key IN '
+                    f'(SELECT key FROM {self.table} ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                    (self.maxsize,)
+                )
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute(f'DELETE FROM {self.table}')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
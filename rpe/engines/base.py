@@ -11,6 +11,18 @@ class Engine(ABC):
     def evaluate(self, resource):
         pass
 
+    # Evaluate several resources, returning one list of evaluations per
+    # resource in input order. Engines that can do better than one evaluation
+    # at a time should override this
+    def evaluate_many(self, resources):
+        return [self.evaluate(resource) for resource in resources]
+
     @abstractmethod
     def remediate(self, resource, policy_id):
         pass
+
+    # Returns a string identifying the current version of the engine's
+    # policies, used to key cached evaluation results. Engines that can't tell
+    # when their policies change return None, and their results aren't cached
+    def revision(self):
+        return None
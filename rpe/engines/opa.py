@@ -13,50 +13,263 @@
 # limitations under the License.
 
 
+import asyncio
+import functools
 import json
 import tenacity
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from urllib import request
-
-from rpe.policy import Evaluation, Policy
+from rpe.policy import Evaluation, Policy, PolicyIndex
 from rpe.exceptions import is_retryable_exception
 from rpe.exceptions import NoSuchEndpoint
 from rpe.exceptions import NoPossibleRemediation
 
 from .base import Engine
+from .transport import ConnectionPool
+
+
+# Shared by the blocking and asyncio request paths
+retry_opa_request = tenacity.retry(
+    retry=tenacity.retry_if_exception(is_retryable_exception),
+    wait=tenacity.wait_random_exponential(multiplier=1, max=10),
+    stop=tenacity.stop_after_attempt(5)
+)
 
 
 class OpenPolicyAgent(Engine):
 
-    def __init__(self, opa_base_url):
+    _headers = {'Content-type': 'application/json'}
+
+    def __init__(self, opa_base_url, batch_size=100, max_batch_bytes=4 * 1024 * 1024, pool_size=10, timeout=None,
+                 max_concurrency=100, policy_cache_ttl=60):
         self.opa_base_url = opa_base_url
+        self.timeout = timeout
+
+        # The policy catalog is cached for policy_cache_ttl seconds (forever
+        # if None), and used to skip evaluations of resource types that no
+        # policy applies to. A ttl of 0 disables both
+        self.policy_cache_ttl = policy_cache_ttl
+        self._catalog = None
+        self._catalog_lock = threading.Lock()
+        self._catalog_fetch_lock = threading.Lock()
+        self._catalog_fetches_async = {}
+        self._revision = None
+        self._revision_fetch_lock = threading.Lock()
+
+        # Keep-alive connections to the OPA server, shared by all threads
+        # using this engine
+        self._pool = ConnectionPool(opa_base_url, maxsize=pool_size, timeout=timeout)
+
+        # The *_async methods make their blocking requests through the same
+        # pool, on up to max_concurrency threads. Requests in flight, from
+        # both paths together, are limited to pool_size connections, so the
+        # threads are capped at that too
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self._async_executor = None
+        self._async_executor_lock = threading.Lock()
 
-    @tenacity.retry(
-        retry=tenacity.retry_if_exception(is_retryable_exception),
-        wait=tenacity.wait_random_exponential(multiplier=1, max=10),
-        stop=tenacity.stop_after_attempt(5)
-    )
+        # Limits for a single evaluate_many request. A resource larger than
+        # max_batch_bytes is still sent, alone in its own request
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+
+    @retry_opa_request
     def _opa_request(self, path, method='GET', data=None):
-        url = '{}/{}'.format(self.opa_base_url, path)
-        headers = {'Content-type': 'application/json'}
-        req = request.Request(
-            url,
-            data=json.dumps(data).encode('utf-8'),
-            method=method,
-            headers=headers
+        resp = self._pool.request(method, path, body=self._encode(data), headers=self._headers)
+        return self._decode(path, resp)
+
+    @retry_opa_request
+    async def _opa_request_async(self, path, method='GET', data=None):
+        loop = asyncio.get_running_loop()
+        resp = await loop.run_in_executor(
+            self._get_async_executor(),
+            functools.partial(self._pool.request, method, path, body=self._encode(data), headers=self._headers)
         )
+        return self._decode(path, resp)
+
+    @staticmethod
+    def _encode(data):
+        # Callers may pass an already-serialized body
+        if isinstance(data, bytes):
+            return data
+
+        return json.dumps(data).encode('utf-8')
+
+    def _decode(self, path, resp):
+        deserialized_resp = json.loads(resp.decode('utf-8'))
+        if 'result' not in deserialized_resp:
+            url = '{}/{}'.format(self.opa_base_url, path)
+            err = "Endpoint {} not found on the OPA server.".format(url)
+            raise NoSuchEndpoint(err)
+
+        return deserialized_resp['result']
+
+    def _get_async_executor(self):
+        with self._async_executor_lock:
+            if self._async_executor is None:
+                self._async_executor = ThreadPoolExecutor(
+                    max_workers=min(self.max_concurrency, self.pool_size),
+                    thread_name_prefix='rpe-opa'
+                )
+
+            return self._async_executor
+
+    def close(self):
+        """ Close idle connections to the OPA server, and stop the threads used by the *_async methods """
+        with self._async_executor_lock:
+            executor = self._async_executor
+            self._async_executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+        self._pool.close()
+
+    def invalidate_policies(self):
+        """ Drop the cached policy catalog, it is fetched again on next use """
+        with self._catalog_lock:
+            self._catalog = None
+            self._revision = None
+
+    def _cached_catalog(self):
+        """ The cached catalog, or None if there isn't a valid one """
+        with self._catalog_lock:
+            catalog = self._catalog
+
+        if catalog is None or (catalog[2] is not None and time.monotonic() >= catalog[2]):
+            return None
+
+        return catalog
+
+    def _cache_catalog(self, policies):
+        # Wildcards in applies_to match the same way as in the python engine
+        index = PolicyIndex((p, p.applies_to) for p in policies)
+
+        if self.policy_cache_ttl is None:
+            expiry = None
+        else:
+            expiry = time.monotonic() + self.policy_cache_ttl
+
+        catalog = (policies, index, expiry)
+        with self._catalog_lock:
+            self._catalog = catalog
+
+        return catalog
+
+    def _policy_catalog(self):
+        """
+        Returns:
+            A tuple of all policies, a PolicyIndex of them and the catalog's expiry
+        """
+        catalog = self._cached_catalog()
+        if catalog is not None:
+            return catalog
+
+        # Threads that find the catalog expired at the same time fetch it once
+        with self._catalog_fetch_lock:
+            catalog = self._cached_catalog()
+            if catalog is None:
+                catalog = self._cache_catalog(self._fetch_policies())
+
+        return catalog
+
+    async def _policy_catalog_async(self):
+        catalog = self._cached_catalog()
+        if catalog is not None:
+            return catalog
+
+        # Coroutines on the same loop that find the catalog expired at the
+        # same time share one fetch
+        loop = asyncio.get_running_loop()
+        with self._catalog_lock:
+            fetch = self._catalog_fetches_async.get(loop)
+            if fetch is None:
+                fetch = self._catalog_fetches_async[loop] = loop.create_task(self._fetch_catalog_async(loop))
+
+        return await asyncio.shield(fetch)
+
+    async def _fetch_catalog_async(self, loop):
+        try:
+            return self._cache_catalog(await self._fetch_policies_async())
+        finally:
+            with self._catalog_lock:
+                del self._catalog_fetches_async[loop]
+
+    def _applies(self, resource_type):
+        if self.policy_cache_ttl == 0:
+            return True
+
+        return bool(self._policy_catalog()[1].match(resource_type))
+
+    async def _applies_async(self, resource_type):
+        if self.policy_cache_ttl == 0:
+            return True
+
+        return bool((await self._policy_catalog_async())[1].match(resource_type))
+
+    def revision(self):
+        """
+        The revisions of the bundles loaded by the OPA server, cached like
+        the policy catalog. None if the server has no bundles, or any bundle
+        has no revision, since changes to its policies can't be detected
+        """
+        cached = self._cached_revision()
+        if cached is not None:
+            return cached[0]
+
+        # Threads that find the revision expired at the same time fetch it
+        # once, without holding up those reading the catalog
+        with self._revision_fetch_lock:
+            cached = self._cached_revision()
+            if cached is not None:
+                return cached[0]
+
+            revision = self._fetch_revision()
+
+            if self.policy_cache_ttl is None:
+                expiry = None
+            else:
+                expiry = time.monotonic() + self.policy_cache_ttl
+
+            with self._catalog_lock:
+                self._revision = (revision, expiry)
+
+        return revision
+
+    def _cached_revision(self):
+        """ The cached (revision, expiry), or None if there isn't a valid one """
+        with self._catalog_lock:
+            cached = self._revision
+
+        if cached is None or (cached[1] is not None and time.monotonic() >= cached[1]):
+            return None
 
-        with request.urlopen(req) as resp:
-            decoded_resp = resp.read().decode('utf-8')
-            deserialized_resp = json.loads(decoded_resp)
-            if 'result' not in deserialized_resp:
-                err = "Endpoint {} not found on the OPA server.".format(url)
-                raise NoSuchEndpoint(err)
+        return cached
 
-            return deserialized_resp['result']
+    def _fetch_revision(self):
+        try:
+            bundles = self._opa_request('system/bundles') or {}
+        except NoSuchEndpoint:
+            bundles = {}
+
+        revisions = [
+            (name, bundle.get('manifest', {}).get('revision', ''))
+            for name, bundle in sorted(bundles.items())
+        ]
+
+        if revisions and all(rev for _, rev in revisions):
+            return json.dumps(revisions)
+
+        return None
 
     # Perform an evaluation on a given resource
     def evaluate(self, resource):
+        if not self._applies(resource.type()):
+            return []
+
         input = {
             'input': resource.get(),
         }
@@ -68,11 +281,97 @@ class OpenPolicyAgent(Engine):
             for ev in evals
         ]
 
+    async def evaluate_async(self, resource):
+        """ Like evaluate(), without blocking the running event loop """
+        if not await self._applies_async(resource.type()):
+            return []
+
+        input = {
+            'input': await self._get_async(resource),
+        }
+
+        evals = await self._opa_request_async('rpe/evaluate', method='POST', data=input)
+
+        return [
+            Evaluation(engine=self, resource=resource, **ev)
+            for ev in evals
+        ]
+
+    @staticmethod
+    async def _get_async(resource):
+        # Resource fetches use blocking api clients, so they run in the loop's
+        # default executor rather than on the loop itself
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, resource.get)
+
+    def evaluate_many(self, resources):
+        """
+        Evaluate resources using as few requests to the OPA server as possible
+
+        Args:
+            resources: An iterable of resources to evaluate
+
+        Returns:
+            A list with one list of evaluations per resource, in input order
+        """
+        resources = list(resources)
+        results = [[] for _ in resources]
+
+        # Only send resources that some policy applies to
+        indexed = [
+            (i, resource) for i, resource in enumerate(resources)
+            if self._applies(resource.type())
+        ]
+
+        for batch in self._batches(indexed):
+            body = b'{"input":{"resources":[' + b','.join(enc for _, _, enc in batch) + b']}}'
+            batch_evals = self._opa_request('rpe/evaluate_batch', method='POST', data=body)
+
+            for (i, resource, _), evals in zip(batch, batch_evals):
+                results[i] = [
+                    Evaluation(engine=self, resource=resource, **ev)
+                    for ev in evals
+                ]
+
+        return results
+
+    def _batches(self, indexed_resources):
+        """ Serialize resources and group them to fit the batch limits """
+        batch = []
+        batch_bytes = 0
+
+        for i, resource in indexed_resources:
+            encoded = json.dumps(resource.get()).encode('utf-8')
+
+            if batch and (len(batch) >= self.batch_size or batch_bytes + len(encoded) > self.max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+
+            batch.append((i, resource, encoded))
+            batch_bytes += len(encoded) + 1
+
+        if batch:
+            yield batch
+
     def policies(self):
         """
         Returns:
-            A list of all configured policies, optionally filtered by a resource_type
+            A list of all configured policies
         """
+        if self.policy_cache_ttl == 0:
+            return self._fetch_policies()
+
+        return list(self._policy_catalog()[0])
+
+    async def policies_async(self):
+        """ Like policies(), without blocking the running event loop """
+        if self.policy_cache_ttl == 0:
+            return await self._fetch_policies_async()
+
+        return list((await self._policy_catalog_async())[0])
+
+    def _fetch_policies(self):
         policies = self._opa_request('rpe/policies')
 
         return [
@@ -80,6 +379,14 @@ class OpenPolicyAgent(Engine):
             for p in policies
         ]
 
+    async def _fetch_policies_async(self):
+        policies = await self._opa_request_async('rpe/policies')
+
+        return [
+            Policy(engine=self, **p)
+            for p in policies
+        ]
+
     def remediate(self, resource, policy_id):
         rem_path = 'rpe/policy/{}/remediate'.format(
             policy_id
@@ -91,3 +398,17 @@ class OpenPolicyAgent(Engine):
             resource.remediate(remediation)
         else:
             raise NoPossibleRemediation("Remediation is not supported for this resource/policy")
+
+    async def remediate_async(self, resource, policy_id):
+        """ Like remediate(), without blocking the running event loop """
+        rem_path = 'rpe/policy/{}/remediate'.format(
+            policy_id
+        )
+        input = {'input': await self._get_async(resource)}
+        remediation = await self._opa_request_async(rem_path, method='POST', data=input)
+
+        if remediation:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, resource.remediate, remediation)
+        else:
+            raise NoPossibleRemediation("Remediation is not supported for this resource/policy")
@@ -13,27 +13,77 @@
 # limitations under the License.
 
 
+import hashlib
+import importlib
 import importlib.util
 import inspect
+import json
+import math
+import os
 import sys
+import threading
 
-from rpe.policy import Evaluation, Policy
+from concurrent.futures import ProcessPoolExecutor
 
+from rpe.policy import Evaluation, Policy, PolicyIndex
 
-class PythonPolicyEngine:
+from .base import Engine
+
+
+class PythonPolicyEngine(Engine):
 
     counter = 0
 
-    def __init__(self, package_path):
+    # Lists the policies in a package, see write_manifest()
+    manifest_name = 'rpe_manifest.json'
+
+    def __init__(self, package_path, mode='thread', processes=None, lazy=False):
+        """
+        Args:
+            package_path: Path to a python package containing policies
+            mode: 'thread' evaluates policies in the calling thread. 'process'
+                evaluates them in a pool of worker processes that each load
+                the policy package, for cpu-heavy policies
+            processes: The number of worker processes in 'process' mode,
+                defaults to the number of cpus
+            lazy: Read the policies from the package's manifest, and only
+                import a policy's module when it is first needed
+        """
+        if mode not in ['thread', 'process']:
+            raise ValueError('Unrecognized execution mode: {}'.format(mode))
+
+        # Policies by name and their type index. Replaced as a whole on reload
+        self._catalog = ({}, PolicyIndex([]))
+
+        # Fingerprints of the package's files as of the last (re)load
+        self._files = {}
+        self._revision = None
+        self._reload_lock = threading.Lock()
+        self._watcher = None
 
-        self._policies={}
         self.package_path = package_path
         PythonPolicyEngine.counter += 1
         self.package_name = 'rpe.plugins.policies.py_' + str(PythonPolicyEngine.counter)
 
+        self.lazy = lazy
+        self.mode = mode
+        self.processes = processes or os.cpu_count()
+        self._process_pool = None
+        self._pool_lock = threading.Lock()
+
         self._load_policies()
 
+    @property
+    def _policies(self):
+        return self._catalog[0]
+
+    @property
+    def _index(self):
+        return self._catalog[1]
+
     def _load_policies(self):
+        files = self._scan_files()
+
         spec = importlib.util.spec_from_file_location(
             self.package_name,
             "{}/__init__.py".format(self.package_path)
@@ -41,11 +91,235 @@ class PythonPolicyEngine:
         module = importlib.util.module_from_spec(spec)
         sys.modules[self.package_name] = module
 
-        spec.loader.exec_module(module)
+        self._package_executed = not self.lazy
+
+        if self.lazy:
+            # The package is registered without being executed, so that its
+            # submodules can be imported on their own
+            with open(os.path.join(self.package_path, self.manifest_name)) as f:
+                manifest = json.load(f)
+
+            self._set_catalog({
+                entry['policy_id']: _LazyPolicy(self, **entry)
+                for entry in manifest['policies']
+            })
+        else:
+            spec.loader.exec_module(module)
+            self._set_catalog(_find_policies(module))
+
+        self._files = files
+
+    def _import_policy_module(self, module):
+        """ Import a module of the policy package, by its relative name """
+        if module:
+            return importlib.import_module('{}.{}'.format(self.package_name, module))
+
+        package = sys.modules[self.package_name]
+        with self._reload_lock:
+            if not self._package_executed:
+                package.__spec__.loader.exec_module(package)
+                self._package_executed = True
+
+        return package
+
+    @classmethod
+    def write_manifest(cls, package_path):
+        """ Import a policy package and write the manifest used by lazy mode """
+        engine = cls(package_path)
+        prefix = engine.package_name + '.'
+
+        # Policies defined outside of a submodule are imported through the
+        # package itself, as the empty module name
+        try:
+            manifest = {'policies': [
+                {
+                    'policy_id': name,
+                    'module': policy_cls.__module__[len(prefix):] if policy_cls.__module__.startswith(prefix) else '',
+                    'applies_to': policy_cls.applies_to,
+                    'description': policy_cls.description,
+                    'components': getattr(policy_cls, 'components', None),
+                }
+                for name, policy_cls in engine._policies.items()
+            ]}
+        finally:
+            engine.close()
+
+        with open(os.path.join(package_path, cls.manifest_name), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def _set_catalog(self, policies):
+        index = PolicyIndex(
+            ((name, policy_cls), policy_cls.applies_to)
+            for name, policy_cls in policies.items()
+        )
+
+        self._catalog = (policies, index)
+
+    def _scan_files(self, previous=None):
+        """
+        Fingerprint the python files in the policy package. Files are only
+        read and hashed if their mtime or size changed since previous
+
+        Returns:
+            A dict of relative path to (mtime, size, sha256) tuples
+        """
+        previous = previous or {}
+        files = {}
+
+        for root, dirs, filenames in os.walk(self.package_path):
+            dirs[:] = [d for d in dirs if d != '__pycache__']
+
+            for filename in filenames:
+                if not filename.endswith('.py') and filename != self.manifest_name:
+                    continue
+
+                path = os.path.join(root, filename)
+                relpath = os.path.relpath(path, self.package_path)
+                stat = os.stat(path)
+
+                known = previous.get(relpath)
+                if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+                    files[relpath] = known
+                    continue
+
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+
+                files[relpath] = (stat.st_mtime_ns, stat.st_size, digest)
+
+        return files
 
-        for name, obj in inspect.getmembers(module):
-            if inspect.isclass(obj) and hasattr(obj, 'applies_to') and isinstance(obj.applies_to, list):
-                self._policies[name] = obj
+    def _module_name(self, relpath):
+        parts = relpath[:-len('.py')].split(os.sep)
+        if parts[-1] == '__init__':
+            parts.pop()
+
+        return '.'.join([self.package_name] + parts)
+
+    def _loaded_modules(self):
+        prefix = self.package_name + '.'
+        return {
+            name: module
+            for name, module in list(sys.modules.items())
+            if name == self.package_name or name.startswith(prefix)
+        }
+
+    def reload(self):
+        """
+        Reload the policy package if any of its files changed. Only modules
+        whose files changed, the modules that use them, and the package itself
+        are executed again, into new module objects. The new policies replace
+        the old ones all at once, and only if every module loaded. Otherwise the
+        old policies stay in place and the error is logged
+
+        Returns:
+            True if the policies were reloaded
+        """
+        with self._reload_lock:
+            files = self._scan_files(self._files)
+
+            changed = {f for f in files.keys() & self._files.keys() if files[f][2] != self._files[f][2]}
+            removed = self._files.keys() - files.keys()
+
+            if not changed and not removed and files.keys() == self._files.keys():
+                self._files = files
+                return False
+
+            previous = self._loaded_modules()
+            package_executed = self._package_executed
+
+            try:
+                if self.lazy:
+                    # Lazy packages are reset, and modules imported again when needed
+                    for name in previous:
+                        del sys.modules[name]
+                    self._load_policies()
+                else:
+                    self._reload_modules(files, changed, removed, previous)
+            except Exception as e:
+                # Policies in use still reference the old modules, so put them back
+                for name in self._loaded_modules():
+                    del sys.modules[name]
+                sys.modules.update(previous)
+                self._package_executed = package_executed
+
+                print(f'Policy reload exception. Package: {self.package_path}, Message: {str(e)}')
+                return False
+
+        # Worker processes have the old policies loaded
+        self._stop_process_pool()
+        return True
+
+    def _reload_modules(self, files, changed, removed, loaded):
+        # Drop modules whose files no longer exist
+        for relpath in removed:
+            sys.modules.pop(self._module_name(relpath), None)
+        loaded = {name: module for name, module in loaded.items() if name in sys.modules}
+
+        dependencies = {
+            name: _module_dependencies(module, loaded)
+            for name, module in loaded.items()
+        }
+
+        # Anything that imports from a changed module holds references to
+        # its old contents, so it needs to be executed again too
+        stale = {self._module_name(f) for f in changed | removed if f.endswith('.py')}
+        pending = list(stale)
+        while pending:
+            name = pending.pop()
+            for dependent, deps in dependencies.items():
+                if name in deps and dependent not in stale:
+                    stale.add(dependent)
+                    pending.append(dependent)
+
+        # New modules are imported by the package when it is executed, so it
+        # comes last
+        stale.discard(self.package_name)
+        order = _dependency_order(stale & loaded.keys(), dependencies) + [self.package_name]
+
+        modules = {}
+        for name in order:
+            module = _new_module(loaded[name])
+            sys.modules[name] = modules[name] = module
+            module.__spec__.loader.exec_module(module)
+
+        policies = _find_policies(modules[self.package_name])
+
+        # Everything loaded, link the new modules into their parents
+        for name, module in modules.items():
+            parent = sys.modules.get(name.rpartition('.')[0])
+            if parent is not None and name != self.package_name:
+                setattr(parent, name.rpartition('.')[2], module)
+
+        self._set_catalog(policies)
+        self._files = files
+
+    def watch(self, interval=5):
+        """ Check for policy changes every interval seconds, in a background thread """
+        if self._watcher is not None:
+            return
+
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.reload()
+                except Exception as e:
+                    print(f'Policy reload exception. Package: {self.package_path}, Message: {str(e)}')
+
+        thread = threading.Thread(target=run, name='rpe-policy-watcher', daemon=True)
+        self._watcher = (thread, stop)
+        thread.start()
+
+    def stop_watching(self):
+        if self._watcher is None:
+            return
+
+        thread, stop = self._watcher
+        stop.set()
+        thread.join()
+        self._watcher = None
 
     def policies(self):
         """
@@ -58,7 +332,8 @@ class PythonPolicyEngine:
                 policy_id=policy_name,
                 engine=self,
                 applies_to=policy_cls.applies_to,
-                description=policy_cls.description
+                description=policy_cls.description,
+                components=getattr(policy_cls, 'components', None)
             )
             for policy_name, policy_cls in self._policies.items()
         ]
@@ -66,39 +341,273 @@ class PythonPolicyEngine:
         return policies
 
     def evaluate(self, resource):
-        matched_policies = dict(filter(
-            lambda policy: resource.type() in policy[1].applies_to,
-            self._policies.items()
-        ))
+        return self.evaluate_many([resource])[0]
+
+    def evaluate_many(self, resources):
+        """
+        Evaluate resources grouped by type, so policies that implement
+        compliant_many() and excluded_many() can check all resources of a type
+        in a single call
+
+        Returns:
+            A list with one list of evaluations per resource, in input order
+        """
+        resources = list(resources)
+
+        if self.mode == 'process':
+            return self._evaluate_in_processes(resources)
 
-        # Loop over policy and build evals, so we can catch exceptions
+        results = [[] for _ in resources]
+        index = self._index
+
+        positions_by_type = {}
+        for i, resource in enumerate(resources):
+            positions_by_type.setdefault(resource.type(), []).append(i)
+
+        for resource_type, positions in positions_by_type.items():
+            batch = [resources[i] for i in positions]
+
+            for policy_name, policy_cls in index.match(resource_type):
+                evals = self._evaluate_policy(policy_name, policy_cls, batch)
+                for i, ev in zip(positions, evals):
+                    if ev is not None:
+                        results[i].append(ev)
+
+        return results
+
+    def _evaluate_policy(self, policy_name, policy_cls, resources):
+        """
+        Returns:
+            A list with an evaluation per resource, or None where the policy
+            raised an exception
+        """
+        compliant = self._run_check(policy_name, policy_cls, 'compliant', resources)
+
+        # Resources that failed the compliance check are not checked further
+        checked = [r for r, c in zip(resources, compliant) if c is not None]
+        excluded = iter(self._run_check(policy_name, policy_cls, 'excluded', checked))
 
         evals = []
+        for resource, is_compliant in zip(resources, compliant):
+            is_excluded = None if is_compliant is None else next(excluded)
 
-        for policy_name, policy_cls in matched_policies.items():
+            if is_excluded is None:
+                evals.append(None)
+                continue
+
+            evals.append(Evaluation(
+                resource=resource,
+                engine=self,
+                policy_id=policy_name,
+                compliant=is_compliant,
+                excluded=is_excluded,
+                remediable=hasattr(policy_cls, 'remediate')
+            ))
+
+        return evals
+
+    def _run_check(self, policy_name, policy_cls, check, resources):
+        """
+        Run a policy's compliant or excluded check, using the batched version
+        (<check>_many) if the policy has one
+
+        Returns:
+            A list with True, False or None (the policy raised an exception)
+            for each resource
+        """
+        if not resources:
+            return []
+
+        check_many = getattr(policy_cls, check + '_many', None)
+        if check_many is not None:
             try:
+                results = check_many(resources)
+
+                # Allow for vectorized results, such as numpy arrays
+                if hasattr(results, 'tolist'):
+                    results = results.tolist()
+                results = list(results)
+
+                if len(results) != len(resources):
+                    raise ValueError(f'{check}_many returned {len(results)} results for {len(resources)} resources')
 
                 # Ensure that these are boolean
-                compliant = policy_cls.compliant(resource) is True
-                excluded = policy_cls.excluded(resource) is True
-
-                ev = Evaluation(
-                    resource=resource,
-                    engine=self,
-                    policy_id=policy_name,
-                    compliant=compliant,
-                    excluded=excluded,
-                    remediable=hasattr(policy_cls, 'remediate')
-                )
+                return [r is True for r in results]
 
-                evals.append(ev)
+            # These are user-provided modules, we need to catch any exception.
+            # Fall back to checking resources one at a time
+            except Exception as e:
+                print(f'Evaluation exception. Policy: {policy_name}, Message: {str(e)}')
 
-            # These are user-provided modules, we need to catch any exception
+        results = []
+        for resource in resources:
+            try:
+                results.append(getattr(policy_cls, check)(resource) is True)
             except Exception as e:
                 print(f'Evaluation exception. Policy: {policy_name}, Message: {str(e)}')
+                results.append(None)
 
-        return evals
+        return results
+
+    def _evaluate_in_processes(self, resources):
+        # Workers get snapshots of the resources, sorted by type so that each
+        # chunk keeps batches of the same type together
+        order = sorted(range(len(resources)), key=lambda i: resources[i].type())
+        snapshots = [resources[i].snapshot() for i in order]
+
+        chunk_size = max(1, math.ceil(len(snapshots) / (self.processes * 4)))
+        chunks = [snapshots[i:i + chunk_size] for i in range(0, len(snapshots), chunk_size)]
+
+        # The chunks are all submitted before the pool can be stopped, and
+        # stopping it waits for them to finish
+        with self._pool_lock:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    initializer=_init_worker,
+                    initargs=(self.package_path,)
+                )
+
+            chunk_results = self._process_pool.map(_worker_evaluate, chunks)
+
+        results = [None] * len(resources)
+        positions = iter(order)
+
+        for chunk_result in chunk_results:
+            for evals in chunk_result:
+                i = next(positions)
+                results[i] = [
+                    Evaluation(resource=resources[i], engine=self, **ev)
+                    for ev in evals
+                ]
+
+        return results
+
+    def _stop_process_pool(self):
+        with self._pool_lock:
+            pool = self._process_pool
+            self._process_pool = None
+
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def close(self):
+        """ Stop any worker processes and watcher, and unload the policy package """
+        self.stop_watching()
+        self._stop_process_pool()
+
+        for name in self._loaded_modules():
+            del sys.modules[name]
+
+    def revision(self):
+        """ A hash of the contents of the loaded policy package """
+        files = self._files
+        if self._revision is None or self._revision[0] is not files:
+            contents = json.dumps(sorted((relpath, f[2]) for relpath, f in files.items()))
+            self._revision = (files, hashlib.sha256(contents.encode('utf-8')).hexdigest())
+
+        return self._revision[1]
 
     def remediate(self, resource, policy_id):
         policy_cls = self._policies[policy_id]
         policy_cls.remediate(resource)
+
+
+def _find_policies(module):
+    """ Policy classes in a module's namespace, by name """
+    return {
+        name: obj
+        for name, obj in inspect.getmembers(module)
+        if inspect.isclass(obj) and hasattr(obj, 'applies_to') and isinstance(obj.applies_to, list)
+    }
+
+
+class _LazyPolicy:
+    """ Stands in for a policy class, importing it on first use """
+
+    def __init__(self, engine, policy_id, module, applies_to, description='', components=None):
+        self._engine = engine
+        self._policy_id = policy_id
+        self._module = module
+        self._cls = None
+
+        self.applies_to = applies_to
+        self.description = description
+        self.components = components
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        if self._cls is None:
+            module = self._engine._import_policy_module(self._module)
+            self._cls = getattr(module, self._policy_id)
+
+        return getattr(self._cls, name)
+
+
+def _module_dependencies(module, modules):
+    """ Names of the modules in modules that module references in its namespace """
+    deps = set()
+    for value in list(vars(module).values()):
+        name = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+        if name in modules and name != module.__name__:
+            deps.add(name)
+
+    return deps
+
+
+def _dependency_order(names, dependencies):
+    """ Order module names so that each comes after the modules it depends on """
+    ordered = []
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        visited.add(name)
+        for dep in sorted(dependencies.get(name, ())):
+            if dep in names:
+                visit(dep)
+        ordered.append(name)
+
+    for name in sorted(names):
+        visit(name)
+
+    return ordered
+
+
+def _new_module(module):
+    """ An empty module with the same spec as module, and its references to loaded submodules """
+    new = importlib.util.module_from_spec(module.__spec__)
+
+    prefix = module.__name__ + '.'
+    for key, value in list(vars(module).items()):
+        if inspect.ismodule(value) and value.__name__.startswith(prefix) and value.__name__ in sys.modules:
+            setattr(new, key, sys.modules[value.__name__])
+
+    return new
+
+
+# The engine used by each worker process in 'process' mode
+_worker_engine = None
+
+
+def _init_worker(package_path):
+    global _worker_engine
+    _worker_engine = PythonPolicyEngine(package_path)
+
+
+def _worker_evaluate(snapshots):
+    return [
+        [
+            {
+                'policy_id': ev.policy_id,
+                'compliant': ev.compliant,
+                'excluded': ev.excluded,
+                'remediable': ev.remediable,
+            }
+            for ev in evals
+        ]
+        for evals in _worker_engine.evaluate_many(snapshots)
+    ]
@@ -0,0 +1,174 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import http.client
+import io
+import queue
+import socket
+import threading
+
+from urllib.error import HTTPError, URLError
+from urllib.parse import unquote, urlparse
+
+
+# Errors that indicate a pooled connection was closed by the server while idle
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+def _parse_base_url(base_url):
+    ''' Split a base url into its scheme, server address and path '''
+    parsed = urlparse(base_url)
+
+    if parsed.scheme in ['http', 'https']:
+        address = (parsed.hostname, parsed.port)
+    elif parsed.scheme == 'unix':
+        address = (unquote(parsed.netloc),)
+    else:
+        raise ValueError('Unsupported url scheme: {}'.format(parsed.scheme))
+
+    return parsed.scheme, address, parsed.path.rstrip('/')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    ''' An HTTP connection over a unix domain socket '''
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__('localhost', **kwargs)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+
+        self.sock = sock
+
+
+class ConnectionPool:
+    ''' A thread-safe pool of keep-alive HTTP connections to a single server
+
+    Servers listening on a unix domain socket are addressed with a unix://
+    url, where the host is the percent-encoded path of the socket:
+
+        unix://%2Fvar%2Frun%2Fopa.sock/v1/data
+
+    Errors are raised the same way urllib.request.urlopen raises them:
+    HTTPError for error responses, and URLError for connection failures.
+    '''
+
+    connection_classes = {
+        'http': http.client.HTTPConnection,
+        'https': http.client.HTTPSConnection,
+        'unix': UnixHTTPConnection,
+    }
+
+    def __init__(self, base_url, maxsize=10, timeout=None):
+        scheme, self._connection_args, self.base_path = _parse_base_url(base_url)
+        self._connection_cls = self.connection_classes[scheme]
+
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        # Idle connections, most recently used first so that warm
+        # connections are reused and extra ones can time out server-side
+        self._idle = queue.LifoQueue()
+
+        # Limits the number of connections checked out at once
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    def _new_connection(self):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        return self._connection_cls(*self._connection_args, **kwargs)
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def _checkin(self, conn, reusable):
+        if reusable:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def request(self, method, path, body=None, headers=None):
+        '''
+        Args:
+            method: The HTTP method
+            path: Request path, relative to the pool's base url
+            body: Request body as bytes
+            headers: Dict of request headers
+
+        Returns:
+            The response body as bytes
+
+        '''
+        url = '{}/{}'.format(self.base_path, path)
+        headers = headers or {}
+
+        conn, reused = self._checkout()
+        reusable = False
+        try:
+            try:
+                resp = self._send(conn, method, url, body, headers)
+            except _STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+
+                # The server closed an idle connection, retry once on a fresh one
+                conn.close()
+                conn = self._new_connection()
+                resp = self._send(conn, method, url, body, headers)
+
+            data = resp.read()
+            reusable = not resp.will_close
+
+        except (OSError, http.client.HTTPException) as e:
+            raise URLError(e)
+        finally:
+            self._checkin(conn, reusable)
+
+        if resp.status >= 400:
+            raise HTTPError(self.base_url + '/' + path, resp.status, resp.reason, resp.headers, io.BytesIO(data))
+
+        return data
+
+    def _send(self, conn, method, url, body, headers):
+        conn.request(method, url, body=body, headers=headers)
+        return conn.getresponse()
+
+    def close(self):
+        ''' Close all idle connections '''
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
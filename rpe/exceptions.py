@@ -49,6 +49,11 @@ class NoPossibleRemediation(Exception):
 class ResourceException(Exception):
     pass
 
+
+class EngineTimeout(Exception):
+    pass
+
+
 class UnsupportedRemediationSpec(Exception):
     pass
 
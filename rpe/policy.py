@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 
 from rpe.engines import Engine
 from rpe.resources import Resource
@@ -10,6 +10,8 @@ class Policy:
     engine: Engine
     applies_to: List[str]
     description: str = ""
+    # Resource components the policy uses, such as 'iam'. None means all of them
+    components: Optional[List[str]] = None
 
 @dataclass
 class Evaluation:
@@ -21,5 +23,60 @@ class Evaluation:
     excluded: bool
     remediable: bool
 
+    # The snapshot of the resource's data that was evaluated, if any
+    snapshot: Optional[Resource] = None
+
     def remediate(self):
-        return self.engine.remediate(self.resource, self.policy_id)
+        resource = self.resource if self.snapshot is None else self.snapshot
+
+        # Evaluations of the same snapshot share it, so after one of them
+        # remediated the resource the others work from its current data
+        if getattr(resource, 'remediated', False):
+            resource = resource.snapshot(refresh=True)
+
+        return self.engine.remediate(resource, self.policy_id)
+
+
+class PolicyIndex:
+    """ Maps resource types to the policies that apply to them
+
+    applies_to entries are either exact resource types, '*' for all types, or
+    a prefix ending with '*', such as 'compute.googleapis.com/*'. Lookups are
+    resolved once per resource type and cached.
+    """
+
+    def __init__(self, entries):
+        """
+        Args:
+            entries: An iterable of (policy, applies_to) pairs
+        """
+        self._exact = {}
+        self._prefixes = []
+        self._matches = {}
+
+        for position, (policy, applies_to) in enumerate(entries):
+            for resource_type in applies_to:
+                if resource_type.endswith('*'):
+                    self._prefixes.append((resource_type[:-1], position, policy))
+                else:
+                    self._exact.setdefault(resource_type, []).append((position, policy))
+
+    def match(self, resource_type):
+        """
+        Returns:
+            A tuple of policies that apply to the resource type, in the order
+            they were given to the index
+        """
+        try:
+            return self._matches[resource_type]
+        except KeyError:
+            pass
+
+        matched = dict(self._exact.get(resource_type, []))
+        for prefix, position, policy in self._prefixes:
+            if resource_type.startswith(prefix):
+                matched[position] = policy
+
+        result = tuple(matched[position] for position in sorted(matched))
+        self._matches[resource_type] = result
+        return result
@@ -14,3 +14,4 @@
 
 
 from .base import Resource    # noqa F401
+from .base import ResourceSnapshot    # noqa F401
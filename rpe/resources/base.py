@@ -36,3 +36,87 @@ class Resource(ABC):
     @abstractmethod
     def type(self):
         pass
+
+    # Returns an immutable snapshot of the resource's current data, so it's
+    # only fetched once however many engines evaluate it. Resources that cache
+    # their data should fetch it again if refresh is True, and resources with
+    # separately fetched components only need those named in components
+    def snapshot(self, refresh=False, components=None):
+        return ResourceSnapshot(self, self.get(), components=components)
+
+
+class ResourceSnapshot(Resource):
+    """ A resource's type and data, fetched once
+
+    get() always returns the data the snapshot was taken with, which must be
+    treated as read-only. Remediation and any other attributes are delegated
+    to the original resource. Once the resource is remediated through the
+    snapshot, its data is out of date, see remediated. Snapshots can be
+    pickled, but the original resource isn't included, so unpickled snapshots
+    can't be remediated.
+    """
+
+    def __init__(self, resource, data, resource_type=None, components=None):
+        object.__setattr__(self, '_origin', resource)
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_type', resource_type or resource.type())
+        object.__setattr__(self, '_components', components)
+        object.__setattr__(self, '_remediated', False)
+
+    @property
+    def origin(self):
+        """ The resource the snapshot was taken from """
+        return self._origin
+
+    @property
+    def components(self):
+        """ The components the snapshot was taken with, None for all of them """
+        return self._components
+
+    @property
+    def remediated(self):
+        """ Whether the resource was remediated through the snapshot since it was taken """
+        return self._remediated
+
+    def get(self, refresh=False):
+        return self._data
+
+    def remediate(self, remediation):
+        if self._origin is None:
+            raise NotImplementedError('Unpickled resource snapshots cannot be remediated')
+
+        try:
+            return self._origin.remediate(remediation)
+        finally:
+            object.__setattr__(self, '_remediated', True)
+
+    def type(self):
+        return self._type
+
+    def snapshot(self, refresh=False, components=None):
+        if refresh and self._origin is not None:
+            if components is None:
+                components = self._components
+            return self._origin.snapshot(refresh=True, components=components)
+
+        return self
+
+    def __getattr__(self, name):
+        # Only called for attributes the snapshot doesn't have
+        origin = self.__dict__.get('_origin')
+        if origin is None:
+            raise AttributeError(name)
+
+        return getattr(origin, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Resource snapshots are immutable')
+
+    def __getstate__(self):
+        return {
+            '_origin': None,
+            '_data': self._data,
+            '_type': self._type,
+            '_components': self._components,
+            '_remediated': self._remediated,
+        }
@@ -0,0 +1,237 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+''' Streaming readers for Cloud Asset Inventory exports
+
+Exports are newline-delimited JSON, optionally gzipped. Records are read one
+line at a time, so memory use doesn't depend on the size of the export.
+'''
+
+import gzip
+import heapq
+import json
+import mmap
+import os
+
+from rpe.exceptions import ResourceException
+from .gcp import GoogleAPIResource
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == _GZIP_MAGIC
+
+
+def _read_lines(path, byte_range=None):
+    if _is_gzip(path):
+        if byte_range is not None:
+            raise ValueError('Byte ranges are not supported for gzipped exports')
+
+        with gzip.open(path, 'rb') as f:
+            yield from f
+        return
+
+    size = os.path.getsize(path)
+    start, end = byte_range or (0, size)
+
+    # Empty files can't be mapped
+    if size == 0 or start >= end:
+        return
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(start)
+        while mm.tell() < end:
+            yield mm.readline()
+
+
+def _read_records(path, byte_range=None):
+    for line in _read_lines(path, byte_range):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            print(f'Skipping CAI record. Path: {path}, Message: {str(e)}')
+            continue
+
+        if not isinstance(record, dict) or 'name' not in record:
+            print(f'Skipping CAI record. Path: {path}, Message: Record has no name')
+            continue
+
+        yield record
+
+
+def _merge_records(records):
+    ''' Merge consecutive records of the same asset, such as its RESOURCE and IAM_POLICY records '''
+    pending = None
+
+    for record in records:
+        if pending is not None and record['name'] == pending['name']:
+            pending.update(record)
+            continue
+
+        if pending is not None:
+            yield pending
+
+        pending = record
+
+    if pending is not None:
+        yield pending
+
+
+def read_cai_export(path, client_kwargs=None, iam_policy_paths=None, byte_range=None, fetch_missing=False,
+                    sorted_by_name=False):
+    '''
+    Yield resources from a Cloud Asset Inventory export
+
+    Consecutive records with the same name are merged, so exports with more
+    than one content type yield a single resource per asset, as long as the
+    records of an asset are next to each other. Records of types without a
+    GoogleAPIResource subclass are skipped. Records that can't be parsed or
+    turned into a resource are logged and skipped.
+
+    Args:
+        path: Path to a newline-delimited JSON export, optionally gzipped
+        client_kwargs: Keyword args for building clients of the resources
+        iam_policy_paths: Paths to IAM_POLICY exports, merged into the records
+            of the same assets. Unless sorted_by_name is set, they're loaded
+            into memory, which takes about as much memory as the size of the
+            files.
+        byte_range: (start, end) offsets of the part of the file to read, as
+            returned by split_cai_export. Not supported for gzipped exports.
+        fetch_missing: Fetch components that aren't in the export from the api
+        sorted_by_name: The export and the IAM_POLICY exports are sorted by
+            asset name, so they're joined as they're read rather than loading
+            the IAM_POLICY exports into memory. Records out of order aren't
+            merged.
+
+    Yields:
+        GoogleAPIResources built with GoogleAPIResource.from_cai_asset
+    '''
+    records = _read_records(path, byte_range)
+    iam_policies = {}
+
+    if sorted_by_name:
+        records = heapq.merge(
+            records,
+            *(_read_records(iam_path) for iam_path in iam_policy_paths or []),
+            key=lambda record: record['name']
+        )
+    else:
+        for iam_path in iam_policy_paths or []:
+            for record in _read_records(iam_path):
+                iam_policies[record['name']] = record.get('iam_policy', record.get('iamPolicy'))
+
+    unsupported_types = set()
+
+    for record in _merge_records(records):
+        asset_type = record.get('asset_type', record.get('assetType'))
+        if asset_type in unsupported_types:
+            continue
+
+        try:
+            GoogleAPIResource.subclass_by_type(asset_type)
+        except ResourceException:
+            unsupported_types.add(asset_type)
+            continue
+
+        if record['name'] in iam_policies:
+            record['iam_policy'] = iam_policies[record['name']]
+
+        try:
+            resource = GoogleAPIResource.from_cai_asset(record, client_kwargs=client_kwargs, fetch_missing=fetch_missing)
+        except Exception as e:
+            print(f'Skipping CAI record. Name: {record["name"]}, Message: {str(e)}')
+            continue
+
+        yield resource
+
+
+def split_cai_export(path, parts):
+    '''
+    Split an uncompressed export into byte ranges that can be read
+    independently, by read_cai_export in separate processes for example
+
+    Ranges start and end on line boundaries, and never split the records of
+    a single asset.
+
+    Args:
+        path: Path to a newline-delimited JSON export
+        parts: The number of ranges to split the file into
+
+    Returns:
+        A list of (start, end) byte offsets, with at most `parts` entries
+    '''
+    if _is_gzip(path):
+        raise ValueError('Gzipped exports can\'t be split')
+
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+
+    boundaries = [0]
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, parts):
+            offset = max(size * i // parts, boundaries[-1])
+            if offset >= size:
+                break
+
+            # Move to the start of the next line
+            mm.seek(offset)
+            if offset > 0 and mm[offset - 1:offset] != b'\n':
+                mm.readline()
+
+            # Move past any more records of the asset on the previous line
+            previous = _line_before(mm, mm.tell())
+            while mm.tell() < size:
+                position = mm.tell()
+                line = mm.readline()
+                name = _record_name(line)
+                if previous is None or name is None or name != _record_name(previous):
+                    mm.seek(position)
+                    break
+                previous = line
+
+            if mm.tell() > boundaries[-1] and mm.tell() < size:
+                boundaries.append(mm.tell())
+
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _line_before(mm, position):
+    if position == 0:
+        return None
+
+    start = mm.rfind(b'\n', 0, position - 1) + 1
+    return mm[start:position]
+
+
+def _record_name(line):
+    line = line.strip()
+    if not line:
+        return None
+
+    # Lines read_cai_export skips are nameless, so they never join a record
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+
+    return record.get('name') if isinstance(record, dict) else None
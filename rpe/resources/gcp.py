@@ -13,10 +13,18 @@
 # limitations under the License.
 
 
+import functools
 import jmespath
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from urllib.parse import urlparse
 from .base import Resource
+from .base import ResourceSnapshot
 from rpe.exceptions import is_retryable_exception
 from rpe.exceptions import ResourceException
 from rpe.exceptions import UnsupportedRemediationSpec
@@ -26,12 +34,200 @@ from googleapiclienthelpers.discovery import build_subresource
 from googleapiclienthelpers.waiter import Waiter
 
 
+# Worker threads for fetching resource components
+_fetch_executor = None
+_fetch_executor_lock = threading.Lock()
+
+
+def _get_fetch_executor():
+    global _fetch_executor
+
+    with _fetch_executor_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='rpe-fetch')
+
+    return _fetch_executor
+
+
+class ClientPool:
+    ''' Process-wide cache of discovery-based api clients
+
+    Clients are keyed by api, resource path, version and the client kwargs
+    (credentials are compared by identity). httplib2 isn't thread-safe, so
+    each thread gets its own clients.
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @staticmethod
+    def _kwargs_key(client_kwargs):
+        key = []
+        for name, value in sorted(client_kwargs.items()):
+            if isinstance(value, (dict, list)):
+                value = repr(value)
+            else:
+                try:
+                    hash(value)
+                except TypeError:
+                    value = ('id', id(value))
+            key.append((name, value))
+
+        return tuple(key)
+
+    def get(self, service_path, version, client_kwargs):
+        '''
+        Args:
+            service_path: The api name and resource path, such as 'storage.buckets'
+            version: The api version
+            client_kwargs: Keyword args for building the client
+
+        Returns:
+            A client for use by the current thread
+        '''
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+
+        key = (service_path, version, self._kwargs_key(client_kwargs))
+        if key not in clients:
+            # Keep a reference to the kwargs, so ids in the key aren't reused
+            clients[key] = (client_kwargs, build_subresource(service_path, version, **client_kwargs))
+
+        return clients[key][1]
+
+    def clear(self):
+        ''' Drop the current thread's clients '''
+        self._local.clients = {}
+
+
+class AncestryCache:
+    ''' Process-wide, TTL and size bounded cache of project ancestry
+
+    Ancestry is keyed by project id. Concurrent lookups of the same project
+    share a single request. Failed lookups are cached for a shorter time, so
+    a project that can't be looked up isn't retried for every resource in it.
+    '''
+
+    def __init__(self, ttl=3600, negative_ttl=60, maxsize=10000):
+        '''
+        Args:
+            ttl: Number of seconds ancestry is kept for
+            negative_ttl: Number of seconds failed lookups are kept for
+            maxsize: The most projects to keep, least recently used ones are evicted first
+        '''
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get(self, project_id, fetch):
+        '''
+        Args:
+            project_id: The project to get the ancestry of
+            fetch: A callable returning the ancestry, used on a cache miss
+
+        Returns:
+            The project's ancestry as a list of resource names, or None if it couldn't be fetched
+        '''
+        with self._lock:
+            entry = self._entries.get(project_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(project_id)
+                return entry[1]
+
+            future = self._in_flight.get(project_id)
+            owner = future is None
+            if owner:
+                future = self._in_flight[project_id] = Future()
+
+        if not owner:
+            return future.result()
+
+        ancestry = None
+        try:
+            ancestry = fetch()
+        except Exception:
+            # This call is best-effort. Any failures should be caught
+            pass
+        finally:
+            with self._lock:
+                self._set(project_id, ancestry)
+                del self._in_flight[project_id]
+            future.set_result(ancestry)
+
+        return ancestry
+
+    def _set(self, project_id, ancestry):
+        now = time.monotonic()
+        ttl = self.ttl if ancestry is not None else self.negative_ttl
+
+        # Drop expired entries before evicting ones that are still valid
+        for key in [key for key, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+
+        self._entries[project_id] = (now + ttl, ancestry)
+        self._entries.move_to_end(project_id)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Characters left unescaped by reserved expansion of uri templates (RFC 6570)
+_reserved_chars = ":/?#[]@!$&'()*+,;="
+
+# Patterns for getting resource data out of Cloud Asset Inventory-formatted resource names
+_cai_name_fields = tuple((field_name, re.compile(pattern)) for field_name, pattern in [
+    # Most resources need only a subset of these fields to query the google apis
+    ('project_id', r'/projects/([^\/]+)/'),
+    ('location', r'/(?:locations|regions|zones)/([^\/]+)/'),
+    ('name', r'([^\/]+)$'),
+
+    # Less-common resource data
+    #  AppEngine
+    ('app', r'/apps/([^\/]+)/'),
+    ('service', r'/services/([^\/]+)/'),
+    ('version', r'/versions/([^\/]+)/'),
+
+    #  NodePools
+    ('cluster', r'/clusters/([^\/]+)/'),
+
+    # ServiceAccounts
+    ('service_account', r'serviceAccounts/([^\/]+)/'),
+])
+
+
 class GoogleAPIResource(Resource):
 
     # Names of the get method of the root resource
     get_method = "get"
     required_resource_data = ['name']
 
+    # Subclasses by resource type
+    _registry = {}
+
+    # Fields parsed out of CAI names for this class
+    _cai_name_fields = _cai_name_fields
+
+    # Shared by all resources, so clients are only built once per thread
+    client_pool = ClientPool()
+
+    # Shared by all resources, so ancestry is only fetched once per project
+    ancestry_cache = AncestryCache()
+
+    # Optional cache of fetched assets and components, such as an
+    # rpe.cache.SqliteCache, which persists between runs. Entries are kept
+    # for metadata_cache_ttl seconds, which can be set per resource class,
+    # or the cache's default ttl if None
+    metadata_cache = None
+    metadata_cache_ttl = None
+
     # jmespath expression for getting labels
     resource_labels_path = "resource.labels"
 
@@ -48,16 +244,27 @@ class GoogleAPIResource(Resource):
     readiness_value = None
     readiness_terminal_values = []
 
+    # Template for the resource's full resource name, formatted with the
+    # resource data. Without one, the name is generated from an api request
+    full_resource_name_template = None
+
+    # Whether the api takes the resource's path in a single parameter, in
+    # which case reserved characters in its values aren't escaped
+    full_resource_name_reserved_expansion = False
+
     def __init__(self, client_kwargs=None, **resource_data):
 
         if client_kwargs is None:
             client_kwargs = {}
 
         # Set some defaults
-        self._service = None
         self._resource_metadata = None
         self._full_resource_name = None
 
+        # Data from a Cloud Asset Inventory record, served by get() in place of api calls
+        self._cai_metadata = None
+        self._cai_fetch_missing = False
+
         # Load and validate additional resource data
         self._resource_data = resource_data
         self._validate_resource_data()
@@ -67,6 +274,10 @@ class GoogleAPIResource(Resource):
 
         self._ancestry = None
 
+        # Concurrent fetches of a resource shared between threads (by
+        # concurrent policy engines, for example) are serialized
+        self._lock = threading.RLock()
+
     def _validate_resource_data(self):
         ''' Verify we have all the required data for this resource '''
         if not all(arg in self._resource_data for arg in self.required_resource_data):
@@ -78,50 +289,43 @@ class GoogleAPIResource(Resource):
                 )
             )
 
-    @staticmethod
-    def _extract_cai_name_data(name):
-        ''' Attempt to get identifiable information out of a Cloud Asset Inventory-formatted resource_name '''
-
-        # Most resources need only a subset of these fields to query the google apis
-        fields = {
-            'project_id': r'/projects/([^\/]+)/',
-            'location': r'/(?:locations|regions|zones)/([^\/]+)/',
-            'name': r'([^\/]+)$',
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
 
+        # Only parse the fields this class needs out of CAI names, plus the project
+        needed = set(cls.required_resource_data) | {'project_id'}
+        cls._cai_name_fields = tuple(
+            (field_name, pattern) for field_name, pattern in _cai_name_fields if field_name in needed
+        )
 
-            # Less-common resource data
-            #  AppEngine
-            'app': r'/apps/([^\/]+)/',
-            'service': r'/services/([^\/]+)/',
-            'version': r'/versions/([^\/]+)/',
-
-            #  NodePools
-            'cluster': r'/clusters/([^\/]+)/',
+        # Register classes that declare their own type, including user-defined
+        # subclasses at any depth
+        if 'resource_type' in cls.__dict__:
+            GoogleAPIResource.register_type(cls.resource_type, cls)
 
-            # ServiceAccounts
-            'service_account': r'serviceAccounts/([^\/]+)/',
-        }
+    @staticmethod
+    def _extract_cai_name_data(name, fields=_cai_name_fields):
+        ''' Attempt to get identifiable information out of a Cloud Asset Inventory-formatted resource_name '''
 
         resource_data = {}
 
         # Extract available resource data from resource name
-        for field_name in fields:
-            m = re.search(fields[field_name], name)
+        for field_name, pattern in fields:
+            m = pattern.search(name)
             if m:
                 resource_data[field_name] = m.group(1)
 
         return resource_data
 
+    @staticmethod
+    def register_type(resource_type, res_cls):
+        ''' Use res_cls for resources of resource_type, replacing any class already registered for it '''
+        GoogleAPIResource._registry[resource_type] = res_cls
+
     @classmethod
     def subclass_by_type(cls, resource_type):
-        mapper = {
-            res_cls.resource_type: res_cls
-
-            for res_cls in cls.__subclasses__()
-        }
-
         try:
-            return mapper[resource_type]
+            return GoogleAPIResource._registry[resource_type]
         except KeyError:
             raise ResourceException('Unrecognized resource type: {}'.format(resource_type))
 
@@ -141,7 +345,7 @@ class GoogleAPIResource(Resource):
 
         res_cls = GoogleAPIResource.subclass_by_type(resource_type)
 
-        resource_data = GoogleAPIResource._extract_cai_name_data(resource_name)
+        resource_data = GoogleAPIResource._extract_cai_name_data(resource_name, res_cls._cai_name_fields)
 
         # if the project_id was passed, and its wasnt found in the resource name, add it
         if project_id and 'project_id' not in resource_data:
@@ -152,6 +356,69 @@ class GoogleAPIResource(Resource):
             **resource_data
         )
 
+    @staticmethod
+    def from_cai_asset(asset, client_kwargs=None, fetch_missing=False):
+        '''
+        Return the appropriate resource using a full Cloud Asset Inventory
+        asset record, as found in CAI exports. get() returns the data from the
+        record without calling the api. Components that aren't in the record
+        are left out of it, unless fetch_missing is set.
+
+        The ancestry of the resource is taken from the record's ancestors,
+        which identify projects by number. Ancestry looked up with the api
+        identifies them by project id instead.
+
+        Args:
+            asset: A dict with the asset's name, asset type, resource data and
+                optionally its iam policy and ancestors
+            client_kwargs: Keyword args for building clients
+            fetch_missing: Fetch components that aren't in the record from
+                the api, the first time get() is called
+
+        Returns:
+            A GoogleAPIResource
+
+        Raises:
+            ResourceException: If the asset type isn't supported, or the
+                record has no resource data
+        '''
+        # Exports use snake_case keys, the api uses camelCase
+        asset_type = asset.get('asset_type', asset.get('assetType'))
+        iam_policy = asset.get('iam_policy', asset.get('iamPolicy'))
+
+        data = (asset.get('resource') or {}).get('data')
+        if data is None:
+            raise ResourceException('Asset has no resource data: {}'.format(asset.get('name')))
+
+        res = GoogleAPIResource.from_cai_data(
+            asset['name'],
+            asset_type,
+            client_kwargs=client_kwargs
+        )
+
+        res._full_resource_name = asset['name']
+
+        metadata = {
+            'type': res.type(),
+            'name': asset['name'],
+            'resource': data,
+        }
+
+        if iam_policy is not None and 'iam' in res.resource_components:
+            metadata['iam'] = iam_policy
+
+        res._cai_metadata = metadata
+        res._cai_fetch_missing = fetch_missing
+
+        # Ancestors are listed nearest first, like getAncestry
+        if asset.get('ancestors'):
+            res._ancestry = [
+                f"//cloudresourcemanager.googleapis.com/{ancestor}"
+                for ancestor in asset['ancestors']
+            ]
+
+        return res
+
     def to_dict(self):
         details = self._resource_data.copy()
         details.update({
@@ -176,12 +443,28 @@ class GoogleAPIResource(Resource):
 
     # Google's documentation describes what it calls a 'full resource name' for
     # resources. None of the API's seem to implement it (except Cloud Asset
-    # Inventory). This attempts to generate it from the discovery-based api
-    # client's generated http request url.
+    # Inventory). Resources with a template format it from their resource
+    # data, escaping values the way the api client would in a request url.
     #
     # If we inject it into the resource, we can use it in policy evaluation to
     # simplify the structure of our policies
     def gen_full_resource_name(self):
+        if self.full_resource_name_template is None:
+            return self._gen_full_resource_name_from_request()
+
+        safe = _reserved_chars if self.full_resource_name_reserved_expansion else ''
+        name = self.full_resource_name_template.format(**{
+            key: quote(str(value), safe=safe) for key, value in self._resource_data.items()
+        })
+
+        # Like names generated from a request url, anything after a ':' in
+        # the last segment is dropped, as it would be a method there
+        head, _, last = name.rpartition('/')
+        self._full_resource_name = '{}/{}'.format(head, last.split(':')[0])
+
+    # This attempts to generate the full resource name from the
+    # discovery-based api client's generated http request url.
+    def _gen_full_resource_name_from_request(self):
 
         method = getattr(self.service, self.get_method)
         uri = method(**self._get_request_args()).uri
@@ -245,7 +528,7 @@ class GoogleAPIResource(Resource):
 
         self._full_resource_name = "//{}.googleapis.com/{}".format(api_name, resource_path)
 
-    def _get_component(self, component):
+    def _component_request(self, component):
         method_name = self.resource_components[component]
 
         # Many components take the same request signature, but allow for custom request
@@ -256,19 +539,86 @@ class GoogleAPIResource(Resource):
             req_arg_method = getattr(self, '_get_request_args')
 
         method = getattr(self.service, method_name)
+        return method(**req_arg_method())
 
-        component_metadata = method(**req_arg_method()).execute()
+    def _get_component(self, component):
+        component_metadata = self._component_request(component).execute()
         return component_metadata
 
-    def get(self, refresh=True):
+    def _start_component_fetches(self, components):
+        '''
+        Start fetching components on worker threads
+
+        Returns:
+            A dict of component name to a callable returning its data
+        '''
+        # Worker threads use their own clients from the pool, unless a custom
+        # http object was given, which all clients would share
+        if 'http' in self._client_kwargs or len(components) == 0:
+            return {
+                c: functools.partial(self._get_component, c)
+                for c in components
+            }
+
+        executor = _get_fetch_executor()
+        return {
+            c: executor.submit(self._get_component, c).result
+            for c in components
+        }
+
+    def _select_components(self, components):
+        ''' The resource's components out of those requested, all of them if components is None '''
+        if components is None:
+            return list(self.resource_components)
+
+        return [c for c in self.resource_components if c in components]
+
+    def get(self, refresh=True, components=None):
+        '''
+        Args:
+            refresh: Fetch the resource even if it has already been fetched
+            components: Names of the resource_components to fetch along with
+                the resource, defaults to all of them
+
+        Returns:
+            A dict with the resource's type, full resource name, data and
+            fetched components
+        '''
+        with self._lock:
+            return self._get(refresh, self._select_components(components))
+
+    def snapshot(self, refresh=False, components=None):
+        return ResourceSnapshot(self, self.get(refresh=refresh, components=components), components=components)
 
+    def _get(self, refresh, components):
+
+        # Data fetched earlier can be reused if it has all the components needed
         if not refresh and self._resource_metadata:
-            return self._resource_metadata
+            if all(c in self._resource_metadata for c in components):
+                return self._resource_metadata
+
+        if self._cai_metadata is not None:
+            return self._get_from_cai(components)
+
+        # Refreshing skips the metadata cache, but still updates it
+        cached = {} if refresh else self._read_metadata_cache(components)
+        if 'resource' in cached:
+            return self._set_fetched_metadata(
+                cached['resource'],
+                self._start_component_fetches([c for c in components if c not in cached]),
+                cached
+            )
 
         method = getattr(self.service, self.get_method)
 
+        # Components are fetched concurrently with the asset, unless we have to
+        # wait for the asset to be ready first
+        wait_for_ready = bool(self.readiness_key and self.readiness_value)
+        if not wait_for_ready:
+            component_fetches = self._start_component_fetches(components)
+
         # If the resource has readiness criteria, wait for it
-        if self.readiness_key and self.readiness_value:
+        if wait_for_ready:
             waiter = Waiter(method, **self._get_request_args())
             asset = waiter.wait(
                 self.readiness_key,
@@ -280,6 +630,14 @@ class GoogleAPIResource(Resource):
         else:
             asset = method(**self._get_request_args()).execute()
 
+        if wait_for_ready:
+            component_fetches = self._start_component_fetches(components)
+
+        return self._set_fetched_metadata(asset, component_fetches)
+
+    def _set_fetched_metadata(self, asset, component_fetches, cached=None):
+        cached = cached or {}
+
         resp = {
             'type': self.type(),
             'name': self.full_resource_name(),
@@ -287,12 +645,201 @@ class GoogleAPIResource(Resource):
 
         resp['resource'] = asset
 
+        fetched = {} if 'resource' in cached else {'resource': asset}
+        for c, fetch in component_fetches.items():
+            fetched[c] = fetch()
+
         for c in self.resource_components:
-            resp[c] = self._get_component(c)
+            if c in cached or c in fetched:
+                resp[c] = cached[c] if c in cached else fetched[c]
+
+        self._write_metadata_cache(fetched)
 
         self._resource_metadata = resp
         return self._resource_metadata
 
+    def _metadata_cache_key(self, part):
+        return '{}#{}'.format(self.full_resource_name(), part)
+
+    def _read_metadata_cache(self, components):
+        '''
+        Returns:
+            A dict of the asset ('resource') and components found in the metadata cache
+        '''
+        if self.metadata_cache is None:
+            return {}
+
+        cached = {}
+        for part in ['resource'] + list(components):
+            value = self.metadata_cache.get(self._metadata_cache_key(part))
+            if value is not None:
+                cached[part] = value
+
+        return cached
+
+    def _write_metadata_cache(self, parts):
+        if self.metadata_cache is None:
+            return
+
+        for part, value in parts.items():
+            self.metadata_cache.set(self._metadata_cache_key(part), value, ttl=self.metadata_cache_ttl)
+
+    def invalidate_metadata_cache(self):
+        ''' Drop the resource's asset and components, including data from a CAI
+        record and entries in the metadata cache, so they're fetched again '''
+        with self._lock:
+            self._resource_metadata = None
+            self._cai_metadata = None
+
+        if self.metadata_cache is None:
+            return
+
+        for part in ['resource'] + list(self.resource_components):
+            self.metadata_cache.delete(self._metadata_cache_key(part))
+
+    def _get_from_cai(self, components):
+        if self._cai_fetch_missing:
+            for c in components:
+                if c not in self._cai_metadata:
+                    self._cai_metadata[c] = self._get_component(c)
+
+        resp = {
+            key: value for key, value in self._cai_metadata.items()
+            if key not in self.resource_components or key in components
+        }
+
+        self._resource_metadata = resp
+        return self._resource_metadata
+
+    @classmethod
+    def get_many(cls, resources, batch_size=100, components=None):
+        '''
+        Fetch many resources, sending the requests for the assets and
+        components of resources of the same api in batches
+
+        Resources with readiness criteria that aren't ready when fetched are
+        fetched again with get(), which waits for them to be ready. Batches
+        are sent to the api's batch endpoint from its discovery document, so
+        resources with an api_endpoint override are fetched one at a time
+
+        Args:
+            resources: A list of GoogleAPIResources
+            batch_size: The most requests to send in a single batch
+            components: Names of the resource_components to fetch, defaults
+                to all of them
+
+        Returns:
+            A list with the data returned by get() for each resource, or the
+            exception raised fetching it, in input order
+
+        '''
+        resources = list(resources)
+        results = [None] * len(resources)
+
+        # Requests in a batch have to go to the same api, with the same credentials
+        groups = {}
+        for i, resource in enumerate(resources):
+            # Resources built from CAI records already have their data, and
+            # batches go to the endpoint from the api's discovery document,
+            # so resources with an api_endpoint override are fetched alone
+            if resource._cai_metadata is not None or resource._api_endpoint() is not None:
+                try:
+                    results[i] = resource.get(components=components)
+                except Exception as e:
+                    results[i] = e
+                continue
+
+            key = (resource.service_name, resource.version, ClientPool._kwargs_key(resource.client_kwargs))
+            groups.setdefault(key, []).append(i)
+
+        for positions in groups.values():
+            batch = []
+            batch_requests = 0
+
+            for i in positions:
+                parts = 1 + len(resources[i]._select_components(components))
+                if batch and batch_requests + parts > batch_size:
+                    cls._get_batch(resources, batch, results, components)
+                    batch = []
+                    batch_requests = 0
+
+                batch.append(i)
+                batch_requests += parts
+
+            if batch:
+                cls._get_batch(resources, batch, results, components)
+
+        return results
+
+    def _api_endpoint(self):
+        client_options = self.client_kwargs.get('client_options') or {}
+        if isinstance(client_options, dict):
+            return client_options.get('api_endpoint')
+
+        return getattr(client_options, 'api_endpoint', None)
+
+    @staticmethod
+    def _get_batch(resources, positions, results, components=None):
+        responses = {}
+
+        def callback(request_id, response, exception):
+            responses[request_id] = exception if exception is not None else response
+
+        # A failure sending the batch fails only the resources in it
+        try:
+            first = resources[positions[0]]
+            api = first.client_pool.get(first.service_name, first.version, first.client_kwargs)
+            batch = api.new_batch_http_request(callback=callback)
+
+            for i in positions:
+                resource = resources[i]
+                method = getattr(resource.service, resource.get_method)
+                batch.add(method(**resource._get_request_args()), request_id=f'{i}/')
+
+                for c in resource._select_components(components):
+                    batch.add(resource._component_request(c), request_id=f'{i}/{c}')
+
+            batch.execute()
+        except Exception as e:
+            for i in positions:
+                results[i] = e
+            return
+
+        for i in positions:
+            resource = resources[i]
+            parts = {'resource': responses.get(f'{i}/')}
+            parts.update({c: responses.get(f'{i}/{c}') for c in resource._select_components(components)})
+
+            error = next((p for p in parts.values() if isinstance(p, Exception)), None)
+            if error is not None:
+                results[i] = error
+                continue
+
+            try:
+                results[i] = resource._set_batch_response(parts)
+            except Exception as e:
+                results[i] = e
+
+    def _set_batch_response(self, parts):
+        asset = parts['resource']
+
+        # Not ready yet, get() waits for it
+        if self.readiness_key and self.readiness_value:
+            if asset.get(self.readiness_key) != self.readiness_value:
+                return self.get(components=[c for c in parts if c != 'resource'])
+
+        resp = {
+            'type': self.type(),
+            'name': self.full_resource_name(),
+        }
+        resp.update(parts)
+
+        with self._lock:
+            self._resource_metadata = resp
+            self._write_metadata_cache(parts)
+
+        return resp
+
     # Determine what remediation steps to take, allow for future remediation specifications
     def remediate(self, remediation):
         # Check for an update spec version, default to version 1
@@ -319,7 +866,12 @@ class GoogleAPIResource(Resource):
     def _call_method(self, method_name, params):
         ''' Call the requested method on the resource '''
         method = getattr(self.service, method_name)
-        return method(**params).execute()
+
+        # The call may change the resource, so data fetched earlier is stale
+        try:
+            return method(**params).execute()
+        finally:
+            self.invalidate_metadata_cache()
 
     @property
     def ancestry(self):
@@ -329,26 +881,59 @@ class GoogleAPIResource(Resource):
         # attempt to fill in the resource's ancestry
         # if the target project has the cloudresourcemanager api disabled, this will fail
         # if the resource_data doesn't include the project_id (ex: with storage buckets) this will also fail
-        try:
-            resource_manager_projects = build_subresource(
-                'cloudresourcemanager.projects', 'v1', **self._client_kwargs
-            )
+        if self.project_id is None:
+            return None
 
-            resp = resource_manager_projects.getAncestry(
-                projectId=self.project_id
-            ).execute()
+        self._ancestry = self.ancestry_cache.get(
+            self.project_id,
+            functools.partial(self._get_ancestry, self.project_id, self._client_kwargs)
+        )
 
-            # Reformat getAncestry response to be a list of resource names
-            self._ancestry = [
-                f"//cloudresourcemanager.googleapis.com/{ancestor['resourceId']['type']}s/{ancestor['resourceId']['id']}"
-                for ancestor in resp.get('ancestor')
-            ]
+        return self._ancestry
 
-        except Exception:
-            # This call is best-effort. Any failures should be caught
-            pass
+    @classmethod
+    def _get_ancestry(cls, project_id, client_kwargs):
+        resource_manager_projects = cls.client_pool.get(
+            'cloudresourcemanager.projects', 'v1', client_kwargs
+        )
 
-        return self._ancestry
+        resp = resource_manager_projects.getAncestry(
+            projectId=project_id
+        ).execute()
+
+        # Reformat getAncestry response to be a list of resource names
+        return [
+            f"//cloudresourcemanager.googleapis.com/{ancestor['resourceId']['type']}s/{ancestor['resourceId']['id']}"
+            for ancestor in resp.get('ancestor')
+        ]
+
+    @classmethod
+    def prefetch_ancestry(cls, resources):
+        ''' Fill the ancestry cache for all distinct projects of the resources
+
+        Lookups of the projects are made concurrently, so later ancestry and
+        organization lookups of the resources are served from the cache.
+
+        Args:
+            resources: An iterable of GoogleAPIResource
+        '''
+        projects = {}
+        for resource in resources:
+            if resource.project_id is not None:
+                projects.setdefault(resource.project_id, resource.client_kwargs)
+
+        executor = _get_fetch_executor()
+        futures = [
+            executor.submit(
+                cls.ancestry_cache.get,
+                project_id,
+                functools.partial(cls._get_ancestry, project_id, client_kwargs)
+            )
+            for project_id, client_kwargs in projects.items()
+        ]
+
+        for future in futures:
+            future.result()
 
     @property
     def organization(self):
@@ -368,26 +953,16 @@ class GoogleAPIResource(Resource):
     @client_kwargs.setter
     def client_kwargs(self, client_kwargs):
 
-        # Invalidate service/parent because client_kwargs changed
-        self._service = None
-
         self._client_kwargs = client_kwargs
 
     @property
     def service(self):
-        if self._service is None:
-
-            full_resource_path = "{}.{}".format(
-                self.service_name,
-                self.resource_path
-            )
+        full_resource_path = "{}.{}".format(
+            self.service_name,
+            self.resource_path
+        )
 
-            self._service = build_subresource(
-                full_resource_path,
-                self.version,
-                **self._client_kwargs
-            )
-        return self._service
+        return self.client_pool.get(full_resource_path, self.version, self._client_kwargs)
 
     @property
     def labels(self):
@@ -411,6 +986,7 @@ class GcpAppEngineInstance(GoogleAPIResource):
     readiness_value = 'RUNNING'
 
     resource_type = 'appengine.googleapis.com/Instance'  # this is made-up based on existing appengine types
+    full_resource_name_template = "//appengine.googleapis.com/apps/{app}/services/{service}/versions/{version}/instances/{name}"
 
     required_resource_data = ['name', 'app', 'service', 'version']
 
@@ -432,6 +1008,8 @@ class GcpBigqueryDataset(GoogleAPIResource):
     required_resource_data = ['name', 'project_id']
 
     resource_type = "bigquery.googleapis.com/Dataset"
+    full_resource_name_template = "//bigquery.googleapis.com/projects/{project_id}/datasets/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -455,6 +1033,8 @@ class GcpBigtableInstance(GoogleAPIResource):
     required_resource_data = ['name', 'project_id']
 
     resource_type = "bigtableadmin.googleapis.com/Instance"
+    full_resource_name_template = "//bigtable.googleapis.com/projects/{project_id}/instances/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -486,6 +1066,8 @@ class GcpCloudFunction(GoogleAPIResource):
     required_resource_data = ['name', 'location', 'project_id']
 
     resource_type = "cloudfunctions.googleapis.com/CloudFunction"  # unreleased
+    full_resource_name_template = "//cloudfunctions.googleapis.com/projects/{project_id}/locations/{location}/functions/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -516,6 +1098,7 @@ class GcpComputeInstance(GoogleAPIResource):
     required_resource_data = ['name', 'location', 'project_id']
 
     resource_type = "compute.googleapis.com/Instance"
+    full_resource_name_template = "//compute.googleapis.com/projects/{project_id}/zones/{location}/instances/{name}"
 
     def _get_request_args(self):
         return {
@@ -534,6 +1117,7 @@ class GcpComputeDisk(GoogleAPIResource):
     required_resource_data = ['name', 'location', 'project_id']
 
     resource_type = "compute.googleapis.com/Disk"
+    full_resource_name_template = "//compute.googleapis.com/projects/{project_id}/zones/{location}/disks/{name}"
 
     def _get_request_args(self):
         return {
@@ -552,6 +1136,7 @@ class GcpComputeRegionDisk(GoogleAPIResource):
     required_resource_data = ['name', 'location', 'project_id']
 
     resource_type = "compute.googleapis.com/RegionDisk"
+    full_resource_name_template = "//compute.googleapis.com/projects/{project_id}/regions/{location}/disks/{name}"
 
     def _get_request_args(self):
         return {
@@ -570,6 +1155,7 @@ class GcpComputeSubnetwork(GoogleAPIResource):
     required_resource_data = ['name', 'location', 'project_id']
 
     resource_type = "compute.googleapis.com/Subnetwork"
+    full_resource_name_template = "//compute.googleapis.com/projects/{project_id}/regions/{location}/subnetworks/{name}"
 
     def _get_request_args(self):
         return {
@@ -588,6 +1174,7 @@ class GcpComputeFirewall(GoogleAPIResource):
     required_resource_data = ['name', 'project_id']
 
     resource_type = "compute.googleapis.com/Firewall"
+    full_resource_name_template = "//compute.googleapis.com/projects/{project_id}/global/firewalls/{name}"
 
     def _get_request_args(self):
         return {
@@ -604,6 +1191,7 @@ class GcpDataprocCluster(GoogleAPIResource):
     required_resource_data = ['name', 'location', 'project_id']
 
     resource_type = "dataproc.googleapis.com/Cluster"
+    full_resource_name_template = "//dataproc.googleapis.com/projects/{project_id}/regions/{location}/clusters/{name}"
 
     def _get_request_args(self):
         return {
@@ -629,6 +1217,8 @@ class GcpDatafusionInstance(GoogleAPIResource):
     }
 
     resource_type = "datafusion.googleapis.com/Instance"
+    full_resource_name_template = "//datafusion.googleapis.com/projects/{project_id}/locations/{location}/instances/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -663,6 +1253,8 @@ class GcpGkeCluster(GoogleAPIResource):
     resource_labels_path = "resource.resourceLabels"
 
     resource_type = "container.googleapis.com/Cluster"
+    full_resource_name_template = "//container.googleapis.com/projects/{project_id}/locations/{location}/clusters/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -686,6 +1278,8 @@ class GcpGkeClusterNodepool(GoogleAPIResource):
     required_resource_data = ['name', 'cluster', 'location', 'project_id']
 
     resource_type = "container.googleapis.com/NodePool"  # beta
+    full_resource_name_template = "//container.googleapis.com/projects/{project_id}/locations/{location}/clusters/{cluster}/nodePools/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -707,6 +1301,8 @@ class GcpIamServiceAccount(GoogleAPIResource):
     required_resource_data = ['name', 'project_id']
 
     resource_type = 'iam.googleapis.com/ServiceAccount'
+    full_resource_name_template = "//iam.googleapis.com/projects/{project_id}/serviceAccounts/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -726,6 +1322,8 @@ class GcpIamServiceAccountKey(GoogleAPIResource):
     required_resource_data = ['name', 'service_account', 'project_id']
 
     resource_type = 'iam.googleapis.com/ServiceAccountKey'
+    full_resource_name_template = "//iam.googleapis.com/projects/{project_id}/serviceAccounts/{service_account}/keys/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -749,6 +1347,8 @@ class GcpPubsubSubscription(GoogleAPIResource):
     }
 
     resource_type = "pubsub.googleapis.com/Subscription"
+    full_resource_name_template = "//pubsub.googleapis.com/projects/{project_id}/subscriptions/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -780,6 +1380,8 @@ class GcpPubsubTopic(GoogleAPIResource):
     }
 
     resource_type = "pubsub.googleapis.com/Topic"
+    full_resource_name_template = "//pubsub.googleapis.com/projects/{project_id}/topics/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -811,6 +1413,7 @@ class GcpStorageBucket(GoogleAPIResource):
     required_resource_data = ['name']
 
     resource_type = "storage.googleapis.com/Bucket"
+    full_resource_name_template = "//storage.googleapis.com/{name}"
 
     def _get_request_args(self):
         return {
@@ -830,6 +1433,7 @@ class GcpSqlInstance(GoogleAPIResource):
     resource_labels_path = "resource.settings.userLabels"
 
     resource_type = "sqladmin.googleapis.com/Instance"
+    full_resource_name_template = "//cloudsql.googleapis.com/projects/{project_id}/instances/{name}"
 
     def _get_request_args(self):
         return {
@@ -849,6 +1453,8 @@ class GcpOrganization(GoogleAPIResource):
     }
 
     resource_type = "cloudresourcemanager.googleapis.com/Organization"
+    full_resource_name_template = "//cloudresourcemanager.googleapis.com/organizations/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -872,6 +1478,7 @@ class GcpProject(GoogleAPIResource):
     }
 
     resource_type = "cloudresourcemanager.googleapis.com/Project"  # beta
+    full_resource_name_template = "//cloudresourcemanager.googleapis.com/projects/{name}"
 
     def _get_request_args(self):
         return {
@@ -894,6 +1501,8 @@ class GcpProjectService(GoogleAPIResource):
     required_resource_data = ['name', 'project_id']
 
     resource_type = 'serviceusage.googleapis.com/Service'
+    full_resource_name_template = "//serviceusage.googleapis.com/projects/{project_id}/services/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -913,6 +1522,7 @@ class GcpDataflowJob(GoogleAPIResource):
     required_resource_data = ['name', 'project_id', 'location']
 
     resource_type = 'dataflow.googleapis.com/Job'
+    full_resource_name_template = "//dataflow.googleapis.com/projects/{project_id}/locations/{location}/jobs/{name}"
 
     def _get_request_args(self):
         return {
@@ -935,6 +1545,8 @@ class GcpRedisInstance(GoogleAPIResource):
     required_resource_data = ['name', 'project_id', 'location']
 
     resource_type = 'redis.googleapis.com/Instance'
+    full_resource_name_template = "//redis.googleapis.com/projects/{project_id}/locations/{location}/instances/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -958,6 +1570,8 @@ class GcpMemcacheInstance(GoogleAPIResource):
     required_resource_data = ['name', 'project_id', 'location']
 
     resource_type = 'memcache.googleapis.com/Instance'
+    full_resource_name_template = "//memcache.googleapis.com/projects/{project_id}/locations/{location}/instances/{name}"
+    full_resource_name_reserved_expansion = True
 
     def _get_request_args(self):
         return {
@@ -13,8 +13,25 @@
 # limitations under the License.
 
 
+import collections
+import hashlib
+import itertools
+import json
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from concurrent.futures import wait
+
+from .cache import MemoryCache
+from .cache import SqliteCache
 from .engines import OpenPolicyAgent
 from .engines import PythonPolicyEngine
+from .exceptions import EngineTimeout
+from .policy import Evaluation
+from .policy import PolicyIndex
 
 
 class RPE:
@@ -22,27 +39,315 @@ class RPE:
     def __init__(self, config):
         self.policy_engines = []
 
+        # Optionally run each engine's evaluation in its own thread. Results
+        # are still returned in engine order. If set, engine_timeout is the
+        # number of seconds to wait for each engine before giving up
+        self.parallel_engines = config.get('parallel_engines', False)
+        self.engine_timeout = config.get('engine_timeout')
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        # Resources are only evaluated by engines with policies for their
+        # type, and not fetched at all if there are none. The index of
+        # policies is rebuilt after policy_index_ttl seconds, 0 disables it
+        self.policy_index_ttl = config.get('policy_index_ttl', 60)
+        self._policy_index = None
+        self._policy_index_expires = 0
+        self._policy_index_lock = threading.Lock()
+
+        # Optionally cache evaluation results by resource data and policy
+        # revisions. Options are maxsize, ttl and path, which stores results
+        # in a SQLite database rather than in memory
+        self.result_cache = None
+        if config.get('result_cache') is not None:
+            self.result_cache = self._build_result_cache(config['result_cache'])
+
         for pe_config in config['policy_engines']:
             self._add_policy_engine(pe_config)
 
+    @staticmethod
+    def _build_result_cache(cache_config):
+        options = dict(cache_config)
+        path = options.pop('path', None)
+        if path is not None:
+            options.setdefault('table', 'results')
+            return SqliteCache(path, **options)
+
+        return MemoryCache(**options)
+
     def _add_policy_engine(self, pe_config):
         if pe_config.get('type') == 'opa':
-            engine = OpenPolicyAgent(pe_config['url'])
+            engine = OpenPolicyAgent(pe_config['url'], **pe_config.get('options', {}))
         elif pe_config.get('type') == 'python':
-            engine = PythonPolicyEngine(pe_config['path'])
+            engine = PythonPolicyEngine(pe_config['path'], **pe_config.get('options', {}))
         else:
             raise AttributeError("Unrecognized policy engine configuration")
 
         self.policy_engines.append(engine)
 
-    def evaluate(self, resource):
-        '''Get all policies that apply to the given resource'''
+    def evaluate(self, resource, refresh=False):
+        '''Get all policies that apply to the given resource
+
+        The resource's data is fetched once, into a snapshot that every engine
+        evaluates. The returned evaluations keep it as their snapshot, and
+        remediate with it
+
+        Args:
+            resource: The resource to evaluate
+            refresh: Fetch the resource's data again, even if it has cached data
+        '''
+        engines, components = self._applicable(resource.type())
+        if not engines:
+            return []
+
+        # Only the components the policies use are fetched
+        snapshot = resource.snapshot(refresh=refresh, components=components)
+
+        cache_key = self._result_cache_key(engines, snapshot)
+        if cache_key is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                return [
+                    Evaluation(resource=resource, engine=self.policy_engines[position], snapshot=snapshot, **fields)
+                    for position, fields in cached
+                ]
+
+        if self.parallel_engines and len(engines) > 1:
+            evaluations = self._evaluate_parallel(engines, snapshot)
+        else:
+            evaluations = []
+            for pe in engines:
+                evaluations.extend(pe.evaluate(snapshot))
+
+        # Engines evaluated the snapshot, but callers get back the resource they passed in
+        for ev in evaluations:
+            ev.resource = resource
+            ev.snapshot = snapshot
+
+        if cache_key is not None:
+            self._cache_results(cache_key, evaluations, snapshot.type())
+
+        return evaluations
+
+    def _result_cache_key(self, engines, snapshot):
+        '''
+        Returns:
+            A hash of the resource's data and the revisions of the engines'
+            policies, or None if the results can't be cached
+        '''
+        if self.result_cache is None:
+            return None
+
+        revisions = []
+        for pe in engines:
+            revision = pe.revision()
+            if revision is None:
+                return None
+            revisions.append((self.policy_engines.index(pe), revision))
+
+        # Policies can also read the resource's ancestry, which isn't part of
+        # its data. Labels are, so they're covered by the data
+        try:
+            ancestry = getattr(snapshot, 'ancestry', None)
+        except Exception:
+            ancestry = None
+
+        try:
+            data = json.dumps([snapshot.get(), ancestry], sort_keys=True, separators=(',', ':'))
+        except (TypeError, ValueError):
+            return None
+
+        key = hashlib.sha256(json.dumps([snapshot.type(), revisions]).encode('utf-8'))
+        key.update(data.encode('utf-8'))
+        return key.hexdigest()
+
+    def _cache_results(self, cache_key, evaluations, resource_type):
+        positions = {id(pe): position for position, pe in enumerate(self.policy_engines)}
+
+        results = []
+        counts = collections.Counter()
+        for ev in evaluations:
+            if id(ev.engine) not in positions:
+                return
+
+            counts[positions[id(ev.engine)]] += 1
+            results.append([positions[id(ev.engine)], {
+                'policy_id': ev.policy_id,
+                'compliant': ev.compliant,
+                'excluded': ev.excluded,
+                'remediable': ev.remediable,
+            }])
+
+        # Engines leave out policies that failed to evaluate, and a failure
+        # shouldn't be served from the cache
+        expected = collections.Counter(position for position, _ in self._matching_policies(resource_type))
+        if any(counts[position] < count for position, count in expected.items()):
+            return
+
+        self.result_cache.set(cache_key, results)
+
+    def _applicable(self, resource_type):
+        '''
+        Returns:
+            The engines with policies that apply to the resource type, in
+            engine order, and the components those policies use (None if any
+            policy uses all of them)
+        '''
+        if not self.policy_index_ttl:
+            return self.policy_engines, None
+
+        matches = self._matching_policies(resource_type)
+
+        components = set()
+        for _, policy_components in matches:
+            if policy_components is None:
+                components = None
+                break
+            components.update(policy_components)
+
+        positions = sorted({position for position, _ in matches})
+        return [self.policy_engines[position] for position in positions], components
+
+    def _matching_policies(self, resource_type):
+        '''
+        Returns:
+            (engine position, components) of each policy that applies to the
+            resource type. Without a policy_index_ttl, policies are listed again
+        '''
+        def build_index():
+            return PolicyIndex(
+                ((position, policy.components), policy.applies_to)
+                for position, pe in enumerate(self.policy_engines)
+                for policy in pe.policies()
+            )
+
+        if not self.policy_index_ttl:
+            return build_index().match(resource_type)
+
+        with self._policy_index_lock:
+            if self._policy_index is None or time.monotonic() >= self._policy_index_expires:
+                self._policy_index = build_index()
+                self._policy_index_expires = time.monotonic() + self.policy_index_ttl
+
+            index = self._policy_index
+
+        return index.match(resource_type)
+
+    def refresh_policies(self):
+        '''Rebuild the index of policies on the next evaluation, after policies change'''
+        with self._policy_index_lock:
+            self._policy_index = None
+
+    def _evaluate_parallel(self, engines, resource):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=4 * len(self.policy_engines),
+                    thread_name_prefix='rpe-engine'
+                )
+            executor = self._executor
+
+        # Each engine gets engine_timeout seconds from when it starts running,
+        # and has to start within engine_timeout seconds of being submitted
+        started = [(threading.Event(), []) for _ in engines]
+
+        def run(pe, start):
+            start[1].append(time.monotonic())
+            start[0].set()
+            return pe.evaluate(resource)
+
+        submitted = time.monotonic()
+        futures = [
+            executor.submit(run, pe, start)
+            for pe, start in zip(engines, started)
+        ]
+
         evaluations = []
-        for pe in self.policy_engines:
-            evaluations.extend(pe.evaluate(resource))
+        for pe, future, start in zip(engines, futures, started):
+            timeout = None
+            if self.engine_timeout is not None:
+                if not start[0].wait(max(0, submitted + self.engine_timeout - time.monotonic())):
+                    raise self._engine_timed_out(executor, futures, pe)
+                timeout = max(0, start[1][0] + self.engine_timeout - time.monotonic())
+
+            try:
+                evaluations.extend(future.result(timeout=timeout))
+            except TimeoutError:
+                raise self._engine_timed_out(executor, futures, pe)
 
         return evaluations
 
+    def _engine_timed_out(self, executor, futures, pe):
+        for f in futures:
+            f.cancel()
+
+        # The engine keeps its worker busy, so later evaluations get a new
+        # executor rather than queueing behind it. The old one's workers exit
+        # once their engines return
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+
+        return EngineTimeout('Policy engine {} did not finish within {} seconds'.format(
+            type(pe).__name__,
+            self.engine_timeout
+        ))
+
+    def evaluate_stream(self, resources, max_workers=8, max_in_flight=None, ordered=True):
+        '''Evaluate many resources concurrently
+
+        Args:
+            resources: An iterable of resources, consumed lazily
+            max_workers: The number of resources evaluated at once
+            max_in_flight: The most resources taken from the iterable but not
+                yet yielded, defaults to twice max_workers
+            ordered: Yield results in input order, rather than as they finish
+
+        Yields:
+            (resource, evaluations) tuples. If evaluating a resource raised an
+            exception, the exception is yielded in place of its evaluations
+
+        '''
+        if max_in_flight is None:
+            max_in_flight = 2 * max_workers
+        max_in_flight = max(max_in_flight, 1)
+
+        resources = iter(resources)
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rpe-stream')
+
+        # Futures of evaluations not yet yielded, mapped to their resources.
+        # Dicts keep insertion order, which is input order
+        pending = {}
+
+        def submit(count):
+            for resource in itertools.islice(resources, count):
+                pending[executor.submit(self._evaluate_captured, resource)] = resource
+
+        try:
+            submit(max_in_flight)
+
+            while pending:
+                if ordered:
+                    done = [next(iter(pending))]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield pending.pop(future), future.result()
+
+                submit(len(done))
+        finally:
+            # The consumer may stop early, don't start any queued evaluations
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _evaluate_captured(self, resource):
+        try:
+            return self.evaluate(resource)
+        except Exception as e:
+            return e
+
     def policies(self):
         '''Get all configured policies'''
         policies = []
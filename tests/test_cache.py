@@ -0,0 +1,74 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+import pytest
+
+from rpe.cache import MemoryCache
+from rpe.cache import SqliteCache
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_cache(request, tmp_path):
+    def make(**kwargs):
+        if request.param == 'memory':
+            return MemoryCache(**kwargs)
+        return SqliteCache(str(tmp_path / 'cache.db'), **kwargs)
+
+    return make
+
+
+def test_cache_lru(make_cache):
+    cache = make_cache(maxsize=2)
+    cache.set('a', [1])
+    cache.set('b', [2])
+
+    # Reading 'a' makes 'b' the least recently used
+    time.sleep(0.01)
+    assert cache.get('a') == [1]
+    cache.set('c', [3])
+
+    assert cache.get('b') is None
+    assert cache.get('a') == [1]
+    assert cache.get('c') == [3]
+
+    cache.delete('a')
+    assert cache.get('a') is None
+
+    cache.clear()
+    assert cache.get('c') is None
+
+
+def test_cache_ttl(make_cache):
+    cache = make_cache(ttl=0.05)
+    cache.set('a', {'value': 1})
+    cache.set('b', {'value': 2}, ttl=60)
+
+    assert cache.get('a') == {'value': 1}
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.get('b') == {'value': 2}
+
+
+def test_sqlite_cache_persists(tmp_path):
+    path = str(tmp_path / 'cache.db')
+
+    cache = SqliteCache(path)
+    cache.set('a', {'value': 1})
+    cache.close()
+
+    assert SqliteCache(path).get('a') == {'value': 1}
+    assert SqliteCache(path, table='other').get('a') is None
@@ -0,0 +1,351 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import json
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+import pytest
+
+from rpe.engines import OpenPolicyAgent
+from rpe.resources import Resource
+
+# Policies served by the stand-in OPA server
+test_policies = {
+    'bucket_versioning': {
+        'applies_to': ['storage.googleapis.com/Bucket'],
+        'description': 'Require versioning',
+    },
+    'project_audit_logs': {
+        'applies_to': ['cloudresourcemanager.googleapis.com/Project'],
+        'description': 'Require audit logs',
+    },
+}
+
+
+def stub_evaluate(res):
+    return [
+        {
+            'policy_id': name,
+            'compliant': res.get('resource', {}).get('compliant', False),
+            'excluded': False,
+            'remediable': False,
+        }
+        for name, p in sorted(test_policies.items())
+        if res['type'] in p['applies_to']
+    ]
+
+
+class StubOpaHandler(BaseHTTPRequestHandler):
+    ''' Mimic the rpe package of an OPA server at /v1/data '''
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _respond(self, result):
+        body = json.dumps({'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = json.loads(self.rfile.read(length) or 'null')
+        self.server.requests.append(self.path)
+
+        if self.path == '/v1/data/rpe/evaluate':
+            self._respond(stub_evaluate(data['input']))
+        elif self.path == '/v1/data/rpe/evaluate_batch':
+            self._respond([stub_evaluate(r) for r in data['input']['resources']])
+        elif self.path == '/v1/data/system/bundles':
+            self._respond(self.server.bundles)
+        elif self.path == '/v1/data/rpe/policies':
+            self._respond([
+                {'policy_id': name, **p}
+                for name, p in sorted(test_policies.items())
+            ])
+        else:
+            body = b'{}'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class StubOpaUnixHandler(StubOpaHandler):
+
+    # Unix sockets don't support TCP_NODELAY
+    disable_nagle_algorithm = False
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(server):
+    server.requests = []
+    server.connections = 0
+    server.bundles = {}
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+
+    return server
+
+
+@pytest.fixture
+def opa_server():
+    server = serve(ThreadingHTTPServer(('127.0.0.1', 0), StubOpaHandler))
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def opa_unix_server(tmp_path):
+    server = serve(ThreadingUnixHTTPServer(str(tmp_path / 'opa.sock'), StubOpaUnixHandler))
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def opa(opa_server):
+    host, port = opa_server.server_address
+    return OpenPolicyAgent('http://{}:{}/v1/data'.format(host, port))
+
+
+class FakeResource(Resource):
+
+    def __init__(self, resource_type, compliant=False):
+        self.resource_type = resource_type
+        self.compliant = compliant
+
+    def get(self):
+        return {
+            'type': self.resource_type,
+            'resource': {'compliant': self.compliant},
+        }
+
+    def remediate(self, remediation):
+        pass
+
+    def type(self):
+        return self.resource_type
+
+
+def test_opa_evaluate(opa):
+    evals = opa.evaluate(FakeResource('storage.googleapis.com/Bucket', compliant=True))
+
+    assert [ev.policy_id for ev in evals] == ['bucket_versioning']
+    assert evals[0].compliant is True
+
+
+def test_opa_evaluate_many(opa, opa_server):
+    resources = [
+        FakeResource('storage.googleapis.com/Bucket', compliant=True),
+        FakeResource('cloudresourcemanager.googleapis.com/Project'),
+        FakeResource('fake.googleapis.com/Widget'),
+    ]
+
+    results = opa.evaluate_many(resources)
+
+    assert opa_server.requests == ['/v1/data/rpe/policies', '/v1/data/rpe/evaluate_batch']
+    assert [[ev.policy_id for ev in evals] for evals in results] == [
+        ['bucket_versioning'],
+        ['project_audit_logs'],
+        [],
+    ]
+    assert results[0][0].resource is resources[0]
+    assert results[0][0].compliant is True
+    assert results[1][0].compliant is False
+
+
+def test_opa_evaluate_many_batch_limits(opa, opa_server):
+    resources = [FakeResource('storage.googleapis.com/Bucket') for _ in range(5)]
+
+    opa.batch_size = 2
+    assert len(opa.evaluate_many(resources)) == 5
+    assert opa_server.requests.count('/v1/data/rpe/evaluate_batch') == 3
+
+    # Every resource is larger than the limit, so each goes in its own request
+    opa_server.requests.clear()
+    opa.batch_size = 100
+    opa.max_batch_bytes = 10
+    assert len(opa.evaluate_many(resources)) == 5
+    assert len(opa_server.requests) == 5
+
+
+def test_opa_reuses_connections(opa, opa_server):
+    for _ in range(5):
+        opa.evaluate(FakeResource('storage.googleapis.com/Bucket'))
+
+    assert opa_server.requests.count('/v1/data/rpe/evaluate') == 5
+    assert opa_server.connections == 1
+
+
+def test_opa_concurrent_requests_share_pool(opa_server):
+    host, port = opa_server.server_address
+    opa = OpenPolicyAgent('http://{}:{}/v1/data'.format(host, port), pool_size=2)
+    resource = FakeResource('storage.googleapis.com/Bucket')
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: opa.evaluate(resource), range(40)))
+
+    assert all(evals[0].policy_id == 'bucket_versioning' for evals in results)
+    assert opa_server.connections <= 2
+
+
+def test_opa_recovers_from_closed_connection(opa, opa_server):
+    opa.evaluate(FakeResource('storage.googleapis.com/Bucket'))
+
+    # Simulate the server dropping the idle keep-alive connection
+    conn = opa._pool._idle.get_nowait()
+    conn.sock.shutdown(socket.SHUT_RDWR)
+    opa._pool._idle.put(conn)
+
+    assert len(opa.evaluate(FakeResource('storage.googleapis.com/Bucket'))) == 1
+
+
+def test_opa_unix_socket(opa_unix_server):
+    opa = OpenPolicyAgent('unix://{}/v1/data'.format(quote(opa_unix_server.server_address, safe='')))
+
+    evals = opa.evaluate(FakeResource('storage.googleapis.com/Bucket', compliant=True))
+    policies = opa.policies()
+
+    assert [ev.policy_id for ev in evals] == ['bucket_versioning']
+    assert [p.policy_id for p in policies] == ['bucket_versioning', 'project_audit_logs']
+    assert opa_unix_server.requests == ['/v1/data/rpe/policies', '/v1/data/rpe/evaluate']
+    assert opa_unix_server.connections == 1
+
+
+def test_opa_evaluate_async(opa_server):
+    host, port = opa_server.server_address
+    opa = OpenPolicyAgent('http://{}:{}/v1/data'.format(host, port), max_concurrency=4)
+    resources = [
+        FakeResource('storage.googleapis.com/Bucket', compliant=bool(i % 2))
+        for i in range(50)
+    ]
+
+    async def run():
+        evals = await asyncio.gather(*[opa.evaluate_async(r) for r in resources])
+        policies = await opa.policies_async()
+        opa.close()
+        return evals, policies
+
+    results, policies = asyncio.run(run())
+
+    assert [evals[0].compliant for evals in results] == [r.compliant for r in resources]
+    assert [p.policy_id for p in policies] == ['bucket_versioning', 'project_audit_logs']
+    assert opa_server.connections <= 4
+
+    # Concurrent first calls fetch the policy catalog once
+    assert opa_server.requests.count('/v1/data/rpe/policies') == 1
+
+    # close() stops the request threads, they're started again on next use
+    assert opa._async_executor is None
+    assert asyncio.run(opa.evaluate_async(resources[1]))[0].compliant is True
+
+
+def test_opa_skips_unsupported_types(opa, opa_server):
+    assert opa.evaluate(FakeResource('fake.googleapis.com/Widget')) == []
+    assert opa.evaluate_many([FakeResource('fake.googleapis.com/Widget')]) == [[]]
+    opa.policies()
+
+    # Only the policy catalog is fetched, once
+    assert opa_server.requests == ['/v1/data/rpe/policies']
+
+    opa.invalidate_policies()
+    opa.policies()
+    assert opa_server.requests == ['/v1/data/rpe/policies'] * 2
+
+
+def test_opa_applicability_wildcards(opa, monkeypatch):
+    monkeypatch.setitem(test_policies, 'compute_labels', {'applies_to': ['compute.googleapis.com/*']})
+
+    assert opa._applies('compute.googleapis.com/Instance')
+    assert opa._applies('storage.googleapis.com/Bucket')
+    assert not opa._applies('fake.googleapis.com/Widget')
+
+
+def test_opa_policy_cache_disabled(opa_server):
+    host, port = opa_server.server_address
+    opa = OpenPolicyAgent('http://{}:{}/v1/data'.format(host, port), policy_cache_ttl=0)
+
+    opa.evaluate(FakeResource('fake.googleapis.com/Widget'))
+    opa.policies()
+    opa.policies()
+
+    assert opa_server.requests == ['/v1/data/rpe/evaluate'] + ['/v1/data/rpe/policies'] * 2
+
+
+def test_opa_revision(opa, opa_server):
+    # Without bundle revisions, changes to policies can't be detected
+    assert opa.revision() is None
+
+    opa_server.bundles = {'rpe': {'manifest': {'revision': 'abc123'}}}
+    assert opa.revision() is None
+
+    opa.invalidate_policies()
+    assert opa.revision() == '[["rpe", "abc123"]]'
+    assert opa_server.requests == ['/v1/data/system/bundles'] * 2
+
+
+def test_opa_revision_fetch_doesnt_block_catalog(opa, opa_server, monkeypatch):
+    opa.policies()
+    fetching = threading.Event()
+    release = threading.Event()
+    fetch_revision = opa._fetch_revision
+
+    def slow_fetch_revision():
+        fetching.set()
+        release.wait(5)
+        return fetch_revision()
+
+    monkeypatch.setattr(opa, '_fetch_revision', slow_fetch_revision)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        revisions = [executor.submit(opa.revision) for _ in range(3)]
+        assert fetching.wait(5)
+
+        # Evaluations read the catalog while the revision is being fetched
+        evals = opa.evaluate(FakeResource('storage.googleapis.com/Bucket'))
+        assert [ev.policy_id for ev in evals] == ['bucket_versioning']
+
+        release.set()
+        assert [f.result() for f in revisions] == [None] * 3
+
+    # Concurrent callers fetch the revision once
+    assert opa_server.requests.count('/v1/data/system/bundles') == 1
@@ -0,0 +1,339 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sys
+import textwrap
+
+import pytest
+
+from rpe.engines import PythonPolicyEngine
+from rpe.policy import PolicyIndex
+from rpe.resources import Resource
+
+test_policies = {
+    '__init__.py': '''
+        from .buckets import BucketVersioning
+        from .common import RequireLabels, ComputeOnly
+    ''',
+    'buckets.py': '''
+        class BucketVersioning:
+            applies_to = ['storage.googleapis.com/Bucket']
+            description = 'Require versioning'
+            components = []
+
+            @staticmethod
+            def compliant(resource):
+                return resource.get()['resource'].get('versioning', False)
+
+            @staticmethod
+            def excluded(resource):
+                return False
+
+            @staticmethod
+            def remediate(resource):
+                pass
+    ''',
+    'common.py': '''
+        class RequireLabels:
+            applies_to = ['*']
+            description = 'Require labels'
+
+            @staticmethod
+            def compliant(resource):
+                return bool(resource.get()['resource'].get('labels'))
+
+            @staticmethod
+            def excluded(resource):
+                return False
+
+        class ComputeOnly:
+            applies_to = ['compute.googleapis.com/*']
+            description = 'Only applies to compute resources'
+
+            @staticmethod
+            def compliant(resource):
+                return True
+
+            @staticmethod
+            def excluded(resource):
+                return True
+    ''',
+}
+
+
+def write_package(path, files):
+    path.mkdir(exist_ok=True)
+    for name, source in files.items():
+        (path / name).write_text(textwrap.dedent(source))
+
+    return str(path)
+
+
+@pytest.fixture
+def policy_path(tmp_path):
+    return write_package(tmp_path / 'policies', test_policies)
+
+
+class FakeResource(Resource):
+
+    def __init__(self, resource_type, **data):
+        self.resource_type = resource_type
+        self.data = data
+
+    def get(self):
+        return {'type': self.resource_type, 'resource': self.data}
+
+    def remediate(self, remediation):
+        pass
+
+    def type(self):
+        return self.resource_type
+
+
+def test_python_policies(policy_path):
+    engine = PythonPolicyEngine(policy_path)
+
+    assert sorted(p.policy_id for p in engine.policies()) == ['BucketVersioning', 'ComputeOnly', 'RequireLabels']
+
+    # Policies can say which resource components they use
+    components = {p.policy_id: p.components for p in engine.policies()}
+    assert components == {'BucketVersioning': [], 'ComputeOnly': None, 'RequireLabels': None}
+
+
+def test_python_evaluate(policy_path):
+    engine = PythonPolicyEngine(policy_path)
+
+    evals = engine.evaluate(FakeResource('storage.googleapis.com/Bucket', versioning=True))
+
+    assert [(ev.policy_id, ev.compliant, ev.remediable) for ev in evals] == [
+        ('BucketVersioning', True, True),
+        ('RequireLabels', False, False),
+    ]
+
+
+def test_python_evaluate_wildcards(policy_path):
+    engine = PythonPolicyEngine(policy_path)
+
+    evals = engine.evaluate(FakeResource('compute.googleapis.com/Instance', labels={'a': 'b'}))
+
+    assert [(ev.policy_id, ev.compliant, ev.excluded) for ev in evals] == [
+        ('ComputeOnly', True, True),
+        ('RequireLabels', True, False),
+    ]
+
+
+def test_policy_index():
+    index = PolicyIndex([
+        ('all', ['*']),
+        ('bucket', ['storage.googleapis.com/Bucket']),
+        ('storage', ['storage.googleapis.com/*', 'storage.googleapis.com/Bucket']),
+    ])
+
+    assert index.match('storage.googleapis.com/Bucket') == ('all', 'bucket', 'storage')
+    assert index.match('storage.googleapis.com/Object') == ('all', 'storage')
+    assert index.match('pubsub.googleapis.com/Topic') == ('all',)
+    assert PolicyIndex([]).match('pubsub.googleapis.com/Topic') == ()
+
+
+batched_policies = {
+    '__init__.py': '''
+        class BatchedTopicPolicy:
+            applies_to = ['pubsub.googleapis.com/Topic']
+            description = 'Checked in batches'
+            calls = []
+
+            @classmethod
+            def compliant_many(cls, resources):
+                cls.calls.append(len(resources))
+                return [r.get()['resource'].get('ok', False) for r in resources]
+
+            @staticmethod
+            def compliant(resource):
+                raise Exception('should use compliant_many')
+
+            @staticmethod
+            def excluded(resource):
+                return False
+
+        class BrokenBatchPolicy:
+            applies_to = ['pubsub.googleapis.com/Topic']
+            description = 'Batch check is broken'
+
+            @staticmethod
+            def compliant_many(resources):
+                raise Exception('broken')
+
+            @staticmethod
+            def compliant(resource):
+                if resource.get()['resource'].get('fail'):
+                    raise Exception('failed')
+                return True
+
+            @staticmethod
+            def excluded(resource):
+                return False
+    ''',
+}
+
+
+def test_python_evaluate_many_batched(tmp_path):
+    engine = PythonPolicyEngine(write_package(tmp_path / 'batched', batched_policies))
+    resources = [
+        FakeResource('pubsub.googleapis.com/Topic', ok=True),
+        FakeResource('storage.googleapis.com/Bucket'),
+        FakeResource('pubsub.googleapis.com/Topic', ok=False, fail=True),
+        FakeResource('pubsub.googleapis.com/Topic', ok=True),
+    ]
+
+    results = engine.evaluate_many(resources)
+    policy_cls = engine._policies['BatchedTopicPolicy']
+
+    # One batched call for all three topics
+    assert policy_cls.calls == [3]
+    assert results[1] == []
+    assert [(ev.policy_id, ev.compliant) for ev in results[0]] == [
+        ('BatchedTopicPolicy', True),
+        ('BrokenBatchPolicy', True),
+    ]
+
+    # The broken batch check falls back to per-resource checks, which fail
+    # for this resource only
+    assert [(ev.policy_id, ev.compliant) for ev in results[2]] == [('BatchedTopicPolicy', False)]
+    assert all(ev.resource is resources[3] for ev in results[3])
+
+
+def test_python_evaluate_process_mode(policy_path):
+    engine = PythonPolicyEngine(policy_path, mode='process', processes=2)
+    resources = [
+        FakeResource('storage.googleapis.com/Bucket', versioning=bool(i % 2), labels={'a': 'b'})
+        for i in range(10)
+    ] + [FakeResource('compute.googleapis.com/Instance')]
+
+    try:
+        results = engine.evaluate_many(resources)
+        single = engine.evaluate(resources[1])
+    finally:
+        engine.close()
+
+    assert [evals[0].compliant for evals in results[:10]] == [bool(i % 2) for i in range(10)]
+    assert all(ev.resource is resources[i] and ev.engine is engine for i, evals in enumerate(results) for ev in evals)
+    assert [ev.policy_id for ev in results[10]] == ['ComputeOnly', 'RequireLabels']
+    assert [ev.policy_id for ev in single] == ['BucketVersioning', 'RequireLabels']
+
+
+def test_python_bad_mode(policy_path):
+    with pytest.raises(ValueError):
+        PythonPolicyEngine(policy_path, mode='fiber')
+
+
+def test_python_reload(tmp_path):
+    path = tmp_path / 'reloadable'
+    engine = PythonPolicyEngine(write_package(path, test_policies))
+    bucket_policy = engine._policies['BucketVersioning']
+    bucket = FakeResource('storage.googleapis.com/Bucket', labels={'a': 'b'})
+
+    revision = engine.revision()
+
+    assert engine.reload() is False
+    assert engine.revision() == revision
+    assert [ev.compliant for ev in engine.evaluate(bucket)] == [False, True]
+
+    # Invert RequireLabels, and drop ComputeOnly
+    write_package(path, {'common.py': test_policies['common.py'].replace(
+        'return bool(', 'return not bool('
+    ).split('        class ComputeOnly')[0]})
+    write_package(path, {'__init__.py': test_policies['__init__.py'].replace(', ComputeOnly', '')})
+
+    assert engine.reload() is True
+    assert engine.revision() != revision
+    assert sorted(engine._policies) == ['BucketVersioning', 'RequireLabels']
+    assert [ev.compliant for ev in engine.evaluate(bucket)] == [False, False]
+
+    # Unchanged modules are not re-executed
+    assert engine._policies['BucketVersioning'] is bucket_policy
+
+
+def test_python_reload_removes_stale_modules(tmp_path):
+    path = tmp_path / 'reloadable'
+    engine = PythonPolicyEngine(write_package(path, test_policies))
+    assert engine.package_name + '.common' in sys.modules
+
+    (path / 'common.py').unlink()
+    write_package(path, {'__init__.py': 'from .buckets import BucketVersioning\n'})
+
+    assert engine.reload() is True
+    assert engine.package_name + '.common' not in sys.modules
+    assert list(engine._policies) == ['BucketVersioning']
+
+    engine.close()
+    assert engine.package_name not in sys.modules
+
+
+def test_python_reload_failure_keeps_policies(tmp_path, capsys):
+    path = tmp_path / 'reloadable'
+    engine = PythonPolicyEngine(write_package(path, dict(test_policies, **{
+        'helper.py': 'def has_labels(resource):\n    return bool(resource.get()["resource"].get("labels"))\n',
+        'common.py': '        from .helper import has_labels\n' + test_policies['common.py'].replace(
+            "bool(resource.get()['resource'].get('labels'))", 'has_labels(resource)'
+        ),
+    })))
+    policies = engine._policies
+    bucket = FakeResource('storage.googleapis.com/Bucket', labels={'a': 'b'})
+    revision = engine.revision()
+
+    write_package(path, {'helper.py': 'def has_labels(resource:\n'})
+
+    assert engine.reload() is False
+    assert 'Policy reload exception' in capsys.readouterr().out
+    assert engine._policies is policies
+    assert engine.revision() == revision
+    assert [ev.compliant for ev in engine.evaluate(bucket)] == [False, True]
+
+    # The fixed module is picked up by the next reload
+    write_package(path, {'helper.py': 'def has_labels(resource):\n    return False\n'})
+
+    assert engine.reload() is True
+    assert [ev.compliant for ev in engine.evaluate(bucket)] == [False, False]
+
+    # Policies from before the reload still use the modules they were loaded from
+    assert policies['RequireLabels'].compliant(bucket) is True
+
+
+def test_python_lazy(tmp_path):
+    path = write_package(tmp_path / 'lazy', test_policies)
+    PythonPolicyEngine.write_manifest(path)
+
+    engine = PythonPolicyEngine(path, lazy=True)
+    buckets_module = engine.package_name + '.buckets'
+    common_module = engine.package_name + '.common'
+
+    assert sorted(p.policy_id for p in engine.policies()) == ['BucketVersioning', 'ComputeOnly', 'RequireLabels']
+    assert {p.policy_id: p.components for p in engine.policies()}['BucketVersioning'] == []
+    assert buckets_module not in sys.modules
+    assert common_module not in sys.modules
+
+    evals = engine.evaluate(FakeResource('pubsub.googleapis.com/Topic', labels={'a': 'b'}))
+
+    # Only the module with matching policies was imported
+    assert [(ev.policy_id, ev.compliant) for ev in evals] == [('RequireLabels', True)]
+    assert buckets_module not in sys.modules
+    assert common_module in sys.modules
+
+    evals = engine.evaluate(FakeResource('storage.googleapis.com/Bucket', versioning=True))
+    assert [(ev.policy_id, ev.compliant, ev.remediable) for ev in evals] == [
+        ('BucketVersioning', True, True),
+        ('RequireLabels', False, False),
+    ]
+    assert buckets_module in sys.modules
@@ -14,11 +14,22 @@
 
 
 import collections
+import json
+import threading
+import time
+
+import httplib2
 import pytest
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse
 
 from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
 
+from rpe.cache import SqliteCache
 from rpe.exceptions import ResourceException
+from rpe.resources.gcp import AncestryCache
 from rpe.resources.gcp import GoogleAPIResource
 from rpe.resources.gcp import GcpAppEngineInstance
 from rpe.resources.gcp import GcpBigqueryDataset
@@ -30,6 +41,7 @@ from rpe.resources.gcp import GcpDatafusionInstance
 from rpe.resources.gcp import GcpDataprocCluster
 from rpe.resources.gcp import GcpGkeCluster
 from rpe.resources.gcp import GcpGkeClusterNodepool
+from rpe.resources.gcp import GcpIamServiceAccount
 from rpe.resources.gcp import GcpOrganization
 from rpe.resources.gcp import GcpProject
 from rpe.resources.gcp import GcpProjectService
@@ -294,6 +306,26 @@ def test_gcp_resource_bad_type():
     assert 'Unrecognized resource type' in str(excinfo.value)
 
 
+def test_gcp_subclass_registry():
+    class CustomBucket(GcpStorageBucket):
+        resource_type = 'custom.googleapis.com/Bucket'
+
+    class CustomBucketChild(CustomBucket):
+        pass
+
+    try:
+        # Deeper subclasses are registered, and inherited types don't replace their parent
+        assert GoogleAPIResource.subclass_by_type('custom.googleapis.com/Bucket') is CustomBucket
+        assert GoogleAPIResource.subclass_by_type('storage.googleapis.com/Bucket') is GcpStorageBucket
+
+        GoogleAPIResource.register_type('custom.googleapis.com/Bucket', CustomBucketChild)
+        r = GoogleAPIResource.from_cai_data('//storage.googleapis.com/my-bucket', 'custom.googleapis.com/Bucket')
+        assert r.__class__ == CustomBucketChild
+        assert r._resource_data == {'name': 'my-bucket'}
+    finally:
+        GoogleAPIResource._registry.pop('custom.googleapis.com/Bucket')
+
+
 @pytest.mark.parametrize(
     "case",
     test_cases,
@@ -303,6 +335,51 @@ def test_gcp_full_resource_name(case):
     assert r.full_resource_name() == case.name
 
 
+def test_gcp_full_resource_name_without_client(monkeypatch):
+    def no_clients(*args, **kwargs):
+        raise AssertionError('Unexpected client construction')
+
+    monkeypatch.setattr(GoogleAPIResource.client_pool, 'get', no_clients)
+
+    r = GcpIamServiceAccount(name='sa@my-project.iam.gserviceaccount.com', project_id='example.com:my-project')
+    assert r.full_resource_name() == (
+        '//iam.googleapis.com/projects/example.com:my-project/serviceAccounts/sa@my-project.iam.gserviceaccount.com'
+    )
+
+    r = GcpComputeInstance(name='my-instance', location='us-central1-a', project_id='example.com:my-project')
+    assert r.full_resource_name() == '//compute.googleapis.com/projects/example.com%3Amy-project/zones/us-central1-a/instances/my-instance'
+
+
+builtin_classes = sorted(
+    (cls for cls in GoogleAPIResource._registry.values() if cls.__module__ == GoogleAPIResource.__module__),
+    key=lambda cls: cls.__name__
+)
+
+
+@pytest.mark.parametrize("separator", ['-', ':'], ids=['plain', 'colon'])
+@pytest.mark.parametrize("cls", builtin_classes, ids=[cls.__name__ for cls in builtin_classes])
+def test_gcp_full_resource_name_template_matches_request(cls, separator):
+    # Names from templates are the same as those generated from api requests
+    fields = set(cls.required_resource_data) | {'project_id'}
+    resource_data = {field: 'my{}{}'.format(separator, field) for field in fields}
+
+    r = cls(client_kwargs=client_kwargs, **resource_data)
+    r._gen_full_resource_name_from_request()
+    from_request = r._full_resource_name
+
+    r = cls(client_kwargs=client_kwargs, **resource_data)
+    assert r.full_resource_name() == from_request
+
+
+def test_gcp_full_resource_name_from_request():
+    # Subclasses without a template fall back to the api request url
+    class TemplatelessBucket(GcpStorageBucket):
+        full_resource_name_template = None
+
+    r = TemplatelessBucket(client_kwargs=client_kwargs, name='my-bucket')
+    assert r.full_resource_name() == '//storage.googleapis.com/my-bucket'
+
+
 def test_missing_resource_data():
     with pytest.raises(ResourceException) as excinfo:
 
@@ -322,3 +399,310 @@ def test_gcp_to_dict():
     data = r.to_dict()
     # with no creds, we should still get this key but it should be none
     assert data['project_id'] == test_project
+
+
+class FakeHttpResponses:
+    ''' Stand in for httplib2 requests, recording the thread of each request '''
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, http, uri, method='GET', body=None, headers=None, **kwargs):
+        path = urlparse(uri).path
+        self.requests.append((path, threading.get_ident()))
+
+        for suffix, data in self.responses.items():
+            if path.endswith(suffix):
+                return httplib2.Response({'status': 200}), json.dumps(data).encode('utf-8')
+
+        return httplib2.Response({'status': 404}), b'{}'
+
+
+def test_gcp_get_fetches_components_concurrently(monkeypatch):
+    fake_http = FakeHttpResponses({
+        '/b/my_resource': {'name': 'my_resource'},
+        '/b/my_resource/iam': {'bindings': []},
+    })
+    monkeypatch.setattr(httplib2.Http, 'request', lambda *args, **kwargs: fake_http.request(*args, **kwargs))
+
+    r = GcpStorageBucket(client_kwargs=client_kwargs, name=test_resource_name)
+    data = r.get()
+
+    assert data == {
+        'type': 'storage.googleapis.com/Bucket',
+        'name': '//storage.googleapis.com/my_resource',
+        'resource': {'name': 'my_resource'},
+        'iam': {'bindings': []},
+    }
+
+    # The iam policy was fetched on another thread
+    threads = dict(fake_http.requests)
+    assert threads['/storage/v1/b/my_resource'] == threading.get_ident()
+    assert threads['/storage/v1/b/my_resource/iam'] != threading.get_ident()
+
+
+def test_gcp_get_selected_components(monkeypatch):
+    fake_http = FakeHttpResponses({
+        '/b/my_resource': {'name': 'my_resource'},
+        '/b/my_resource/iam': {'bindings': []},
+    })
+    monkeypatch.setattr(httplib2.Http, 'request', lambda *args, **kwargs: fake_http.request(*args, **kwargs))
+
+    r = GcpStorageBucket(client_kwargs=client_kwargs, name=test_resource_name)
+
+    assert 'iam' not in r.get(components=[])
+    assert [path for path, _ in fake_http.requests] == ['/storage/v1/b/my_resource']
+
+    # Cached data is only reused if it has the components needed
+    assert r.snapshot(components=[]).get() == r.get(refresh=False, components=[])
+    assert r.snapshot(components=['iam']).get()['iam'] == {'bindings': []}
+    assert len(fake_http.requests) == 3
+
+
+def test_gcp_metadata_cache(monkeypatch, tmp_path):
+    fake_http = FakeHttpResponses({
+        '/b/my_resource': {'name': 'my_resource'},
+        '/b/my_resource/iam': {'bindings': []},
+    })
+    monkeypatch.setattr(httplib2.Http, 'request', lambda *args, **kwargs: fake_http.request(*args, **kwargs))
+    monkeypatch.setattr(GoogleAPIResource, 'metadata_cache', SqliteCache(str(tmp_path / 'metadata.db')))
+
+    data = GcpStorageBucket(client_kwargs=client_kwargs, name=test_resource_name).get(refresh=False)
+    assert len(fake_http.requests) == 2
+
+    # Other instances of the resource are served from the cache, unless refreshed
+    r = GcpStorageBucket(client_kwargs=client_kwargs, name=test_resource_name)
+    assert r.get(refresh=False) == data
+    assert len(fake_http.requests) == 2
+
+    r.get()
+    assert len(fake_http.requests) == 4
+
+    # Remediation drops the cached data, and the data of the remediated instance
+    r._call_method('patch', {'bucket': test_resource_name, 'body': {}})
+    r.get(refresh=False)
+    assert len(fake_http.requests) == 7
+
+    GcpStorageBucket(client_kwargs=client_kwargs, name=test_resource_name).get(refresh=False)
+    assert len(fake_http.requests) == 7
+
+    # Without a cache, the remediated instance is still fetched again
+    monkeypatch.setattr(GoogleAPIResource, 'metadata_cache', None)
+    r._call_method('patch', {'bucket': test_resource_name, 'body': {}})
+    r.get(refresh=False)
+    assert len(fake_http.requests) == 10
+
+    # Entries expire after the ttl of their resource type
+    monkeypatch.setattr(GoogleAPIResource, 'metadata_cache', SqliteCache(str(tmp_path / 'metadata.db')))
+    monkeypatch.setattr(GcpStorageBucket, 'metadata_cache_ttl', 0)
+    GcpStorageBucket(client_kwargs=client_kwargs, name=test_resource_name).get()
+    GcpStorageBucket(client_kwargs=client_kwargs, name=test_resource_name).get(refresh=False)
+    assert len(fake_http.requests) == 14
+
+
+def test_gcp_client_pool_shares_clients():
+    a = GcpStorageBucket(client_kwargs=client_kwargs, name='a')
+    b = GcpStorageBucket(client_kwargs=dict(client_kwargs), name='b')
+    assert a.service is b.service
+
+    other = GcpStorageBucket(client_kwargs={'credentials': Credentials(token='')}, name='c')
+    assert other.service is not a.service
+
+    # Clients aren't shared between threads
+    services = []
+    thread = threading.Thread(target=lambda: services.append(a.service))
+    thread.start()
+    thread.join()
+    assert services[0] is not a.service
+
+
+
+def test_gcp_ancestry_cache(monkeypatch):
+    ancestry = {'ancestor': [
+        {'resourceId': {'type': 'project', 'id': 'cached-project'}},
+        {'resourceId': {'type': 'organization', 'id': '1234'}},
+    ]}
+    fake_http = FakeHttpResponses({
+        '/projects/cached-project:getAncestry': ancestry,
+    })
+    monkeypatch.setattr(httplib2.Http, 'request', lambda *args, **kwargs: fake_http.request(*args, **kwargs))
+    GoogleAPIResource.ancestry_cache.clear()
+
+    instances = [
+        GcpComputeInstance(client_kwargs=client_kwargs, name='vm-{}'.format(i), location='us-central1-a', project_id='cached-project')
+        for i in range(10)
+    ]
+    GoogleAPIResource.prefetch_ancestry(instances)
+
+    for instance in instances:
+        assert instance.organization == '//cloudresourcemanager.googleapis.com/organizations/1234'
+
+    assert len(fake_http.requests) == 1
+
+    # Failed lookups are cached for a shorter time
+    missing = GcpComputeInstance(client_kwargs=client_kwargs, name='vm', location='us-central1-a', project_id='missing')
+    assert missing.ancestry is None
+    assert missing.ancestry is None
+    assert len(fake_http.requests) == 2
+
+
+def test_ancestry_cache_bounds(monkeypatch):
+    cache = AncestryCache(ttl=100, negative_ttl=10, maxsize=2)
+    now = [0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    fetches = []
+
+    def fetch(project_id, fail=False):
+        def fetch():
+            fetches.append(project_id)
+            if fail:
+                raise Exception('lookup failed')
+            return ['projects/' + project_id]
+        return fetch
+
+    assert cache.get('a', fetch('a')) == ['projects/a']
+    assert cache.get('b', fetch('b', fail=True)) is None
+    assert cache.get('b', fetch('b')) is None
+
+    # The failure expires before the ancestry does
+    now[0] = 20
+    assert cache.get('b', fetch('b')) == ['projects/b']
+    assert cache.get('a', fetch('a')) == ['projects/a']
+    assert fetches == ['a', 'b', 'b']
+
+    # 'b' is the least recently used
+    cache.get('c', fetch('c'))
+    assert list(cache._entries) == ['a', 'c']
+
+    # Expired entries are dropped when another is added
+    now[0] = 200
+    cache.get('d', fetch('d'))
+    assert list(cache._entries) == ['d']
+
+
+class StubBatchHandler(BaseHTTPRequestHandler):
+    ''' Answer Google API requests, and batches of them, with the resource path and method of each '''
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = BytesParser().parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode('utf-8') + b'\r\n\r\n' + body
+        )
+        self.server.batches.append((self.path, len(message.get_payload())))
+
+        # Fail the whole batch if any of its requests is for a broken resource
+        if any(' /storage/v1/b/broken' in part.get_payload() for part in message.get_payload()):
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        boundary = 'stub_batch_boundary'
+        replies = []
+        for part in message.get_payload():
+            request_line = part.get_payload().splitlines()[0]
+            method, path, _ = request_line.split(' ')
+            path = urlparse(path).path
+
+            if path.endswith('/missing'):
+                status, data = '404 Not Found', {'error': {'code': 404, 'message': 'Not found'}}
+            else:
+                status, data = '200 OK', {'path': path, 'method': method}
+
+            replies.append(
+                '--{}\r\nContent-Type: application/http\r\nContent-ID: {}\r\n\r\n'
+                'HTTP/1.1 {}\r\nContent-Type: application/json\r\n\r\n{}\r\n'.format(
+                    boundary,
+                    part['Content-ID'].replace('<', '<response-', 1),
+                    status,
+                    json.dumps(data),
+                )
+            )
+
+        content = (''.join(replies) + '--{}--\r\n'.format(boundary)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/mixed; boundary="{}"'.format(boundary))
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        content = json.dumps({'path': urlparse(self.path).path, 'method': 'GET'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def batch_server():
+    server = HTTPServer(('127.0.0.1', 0), StubBatchHandler)
+    server.batches = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def batch_endpoint(batch_server, monkeypatch):
+    ''' Send requests for the default storage endpoint to the stub batch server '''
+    host, port = batch_server.server_address
+    request = httplib2.Http.request
+
+    def redirect(http, uri, *args, **kwargs):
+        uri = uri.replace('https://storage.googleapis.com/', 'http://{}:{}/'.format(host, port), 1)
+        return request(http, uri, *args, **kwargs)
+
+    monkeypatch.setattr(httplib2.Http, 'request', redirect)
+    return batch_server
+
+
+def test_gcp_get_many(batch_endpoint):
+    buckets = [GcpStorageBucket(client_kwargs=client_kwargs, name='bucket-{}'.format(i)) for i in range(5)]
+    buckets.append(GcpStorageBucket(client_kwargs=client_kwargs, name='missing'))
+
+    results = GoogleAPIResource.get_many(buckets, batch_size=4)
+
+    # Each bucket needs two requests, so two buckets fit in each batch
+    assert batch_endpoint.batches == [('/batch/storage/v1', 4)] * 3
+    assert results[0] == {
+        'type': 'storage.googleapis.com/Bucket',
+        'name': '//storage.googleapis.com/bucket-0',
+        'resource': {'path': '/storage/v1/b/bucket-0', 'method': 'GET'},
+        'iam': {'path': '/storage/v1/b/bucket-0/iam', 'method': 'GET'},
+    }
+    assert buckets[4].get(refresh=False)['resource']['path'] == '/storage/v1/b/bucket-4'
+    assert isinstance(results[5], HttpError)
+
+
+def test_gcp_get_many_batch_failure(batch_endpoint):
+    names = ['bucket-0', 'bucket-1', 'broken', 'bucket-3', 'bucket-4']
+    buckets = [GcpStorageBucket(client_kwargs=client_kwargs, name=name) for name in names]
+
+    results = GoogleAPIResource.get_many(buckets, batch_size=4)
+
+    # Only the resources in the failed batch get its error
+    assert len(batch_endpoint.batches) == 3
+    assert [isinstance(r, HttpError) for r in results] == [False, False, True, True, False]
+    assert results[4]['resource']['path'] == '/storage/v1/b/bucket-4'
+
+
+def test_gcp_get_many_api_endpoint(batch_server):
+    host, port = batch_server.server_address
+    kwargs = dict(client_kwargs, client_options={'api_endpoint': 'http://{}:{}/storage/v1/'.format(host, port)})
+
+    bucket = GcpStorageBucket(client_kwargs=kwargs, name='bucket-0')
+    results = GoogleAPIResource.get_many([bucket])
+
+    # Resources with an endpoint override aren't batched
+    assert batch_server.batches == []
+    assert results[0]['resource'] == {'path': '/storage/v1/b/bucket-0', 'method': 'GET'}
@@ -14,11 +14,18 @@
 
 
 import collections
+import gzip
+import json
+from urllib.parse import urlparse
+
+import httplib2
 import pytest
 
 from google.oauth2.credentials import Credentials
 
 from rpe.exceptions import ResourceException
+from rpe.resources.cai import read_cai_export
+from rpe.resources.cai import split_cai_export
 from rpe.resources.gcp import GoogleAPIResource
 from rpe.resources.gcp import GcpAppEngineInstance
 from rpe.resources.gcp import GcpBigqueryDataset
@@ -255,3 +262,194 @@ def test_bad_resource_type():
         )
 
     assert 'Unrecognized resource type' in str(excinfo.value)
+
+
+def test_gcp_resource_from_cai_asset(monkeypatch):
+    def no_requests(*args, **kwargs):
+        raise AssertionError('Unexpected api request')
+
+    monkeypatch.setattr(httplib2.Http, 'request', no_requests)
+
+    asset = {
+        "name": "//storage.googleapis.com/test-bucket",
+        "asset_type": "storage.googleapis.com/Bucket",
+        "resource": {"data": {"name": "test-bucket", "versioning": {"enabled": True}}},
+        "iam_policy": {"bindings": [{"role": "roles/storage.admin", "members": ["user:a@example.com"]}]},
+        "ancestors": ["projects/1234", "folders/5678", "organizations/9012"],
+    }
+
+    r = GoogleAPIResource.from_cai_asset(asset, client_kwargs=client_kwargs)
+    assert r.__class__ == GcpStorageBucket
+
+    assert r.get() == {
+        'type': 'storage.googleapis.com/Bucket',
+        'name': '//storage.googleapis.com/test-bucket',
+        'resource': asset['resource']['data'],
+        'iam': asset['iam_policy'],
+    }
+    assert r.organization == '//cloudresourcemanager.googleapis.com/organizations/9012'
+
+
+def test_gcp_resource_from_cai_asset_missing_components(monkeypatch):
+    requests = []
+
+    def fake_request(http, uri, *args, **kwargs):
+        requests.append(urlparse(uri).path)
+        return httplib2.Response({'status': 200}), b'{"bindings": []}'
+
+    monkeypatch.setattr(httplib2.Http, 'request', fake_request)
+
+    asset = {
+        "name": "//storage.googleapis.com/test-bucket",
+        "asset_type": "storage.googleapis.com/Bucket",
+        "resource": {"data": {"name": "test-bucket"}},
+    }
+
+    # Components that aren't in the record are left out, without api calls
+    r = GoogleAPIResource.from_cai_asset(asset, client_kwargs=client_kwargs)
+    assert r.get() == {
+        'type': 'storage.googleapis.com/Bucket',
+        'name': '//storage.googleapis.com/test-bucket',
+        'resource': asset['resource']['data'],
+    }
+    assert requests == []
+
+    r = GoogleAPIResource.from_cai_asset(asset, client_kwargs=client_kwargs, fetch_missing=True)
+    assert r.get()['iam'] == {'bindings': []}
+    assert requests == ['/storage/v1/b/test-bucket/iam']
+
+
+def test_gcp_resource_from_cai_asset_without_data():
+    asset = {
+        "name": "//storage.googleapis.com/test-bucket",
+        "asset_type": "storage.googleapis.com/Bucket",
+        "iam_policy": {"bindings": []},
+    }
+
+    with pytest.raises(ResourceException) as excinfo:
+        GoogleAPIResource.from_cai_asset(asset, client_kwargs=client_kwargs)
+
+    assert 'no resource data' in str(excinfo.value)
+
+
+export_records = [
+    {
+        "name": "//storage.googleapis.com/bucket-0",
+        "asset_type": "storage.googleapis.com/Bucket",
+        "resource": {"data": {"name": "bucket-0"}},
+    },
+    {
+        "name": "//storage.googleapis.com/bucket-0",
+        "asset_type": "storage.googleapis.com/Bucket",
+        "iam_policy": {"bindings": []},
+    },
+    {
+        "name": "//cloudfakeservice.googleapis.com/widgets/widget",
+        "asset_type": "cloudfakeservice.googleapis.com/Widget",
+        "resource": {"data": {"name": "widget"}},
+    },
+] + [
+    {
+        "name": "//storage.googleapis.com/bucket-{}".format(i),
+        "asset_type": "storage.googleapis.com/Bucket",
+        "resource": {"data": {"name": "bucket-{}".format(i)}},
+        "iam_policy": {"bindings": []},
+    }
+    for i in range(1, 20)
+]
+
+
+def write_export(path, records, compress=False):
+    data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+    if compress:
+        data = gzip.compress(data)
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("compress", [False, True], ids=['plain', 'gzip'])
+def test_read_cai_export(tmp_path, compress):
+    path = write_export(tmp_path / 'export.json', export_records, compress=compress)
+
+    resources = list(read_cai_export(path, client_kwargs=client_kwargs))
+
+    assert [r.full_resource_name() for r in resources] == [
+        "//storage.googleapis.com/bucket-{}".format(i) for i in range(20)
+    ]
+    assert all(isinstance(r, GcpStorageBucket) for r in resources)
+    assert resources[0].get()['iam'] == {"bindings": []}
+
+
+@pytest.mark.parametrize("sorted_by_name", [False, True], ids=['unsorted', 'sorted'])
+def test_read_cai_export_iam_policy_file(tmp_path, sorted_by_name):
+    resource_records = [export_records[0]] + [dict(r, iam_policy=None) for r in export_records[3:6]]
+    path = write_export(tmp_path / 'resources.json', resource_records)
+    iam_path = write_export(tmp_path / 'iam.json', [
+        export_records[1],
+        dict(export_records[1], name='//storage.googleapis.com/bucket-2', iam_policy={'bindings': ['b']}),
+    ])
+
+    resources = list(read_cai_export(
+        path,
+        client_kwargs=client_kwargs,
+        iam_policy_paths=[iam_path],
+        sorted_by_name=sorted_by_name,
+    ))
+
+    assert [r.get().get('iam') for r in resources] == [{"bindings": []}, None, {'bindings': ['b']}, None]
+
+
+def test_read_cai_export_bad_records(tmp_path, capsys):
+    path = tmp_path / 'export.json'
+    write_export(path, export_records[3:5])
+    path.write_bytes(
+        b'{"name": "//storage.googleapis.com/broken", \n'
+        + json.dumps({"name": "//storage.googleapis.com/no-data", "asset_type": "storage.googleapis.com/Bucket"}).encode()
+        + b'\n'
+        + path.read_bytes()
+    )
+
+    resources = list(read_cai_export(str(path), client_kwargs=client_kwargs))
+
+    # Bad records are skipped, and the rest of the export is still read
+    assert [r.full_resource_name() for r in resources] == [
+        '//storage.googleapis.com/bucket-1',
+        '//storage.googleapis.com/bucket-2',
+    ]
+    assert capsys.readouterr().out.count('Skipping CAI record') == 2
+
+
+def test_split_cai_export(tmp_path):
+    path = write_export(tmp_path / 'export.json', export_records)
+
+    ranges = split_cai_export(path, len(export_records))
+    assert 1 < len(ranges) <= len(export_records)
+
+    names = [
+        r.full_resource_name()
+        for byte_range in ranges
+        for r in read_cai_export(path, client_kwargs=client_kwargs, byte_range=byte_range)
+    ]
+    assert names == ["//storage.googleapis.com/bucket-{}".format(i) for i in range(20)]
+
+    # The records of an asset aren't split between ranges
+    second_record = len(json.dumps(export_records[0])) + 1
+    assert second_record not in [start for start, end in ranges]
+
+
+def test_split_cai_export_bad_records(tmp_path, capsys):
+    path = tmp_path / 'export.json'
+    write_export(path, export_records[3:8])
+    lines = path.read_bytes().splitlines(keepends=True)
+    path.write_bytes(b''.join(lines[:2] + [b'{"name": "//storage.googleapis.com/broken", \n'] + lines[2:]))
+
+    assert len(list(read_cai_export(str(path), client_kwargs=client_kwargs))) == 5
+
+    # Bad lines are skipped in each range, like in the whole export
+    ranges = split_cai_export(str(path), 3)
+    names = [
+        r.full_resource_name()
+        for byte_range in ranges
+        for r in read_cai_export(str(path), client_kwargs=client_kwargs, byte_range=byte_range)
+    ]
+    assert names == ["//storage.googleapis.com/bucket-{}".format(i) for i in range(1, 6)]
@@ -0,0 +1,452 @@
+# Copyright 2020 The resource-policy-evaluation-library Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+import pytest
+from google.oauth2.credentials import Credentials
+
+from rpe import RPE
+from rpe.engines import Engine
+from rpe.exceptions import EngineTimeout
+from rpe.policy import Evaluation, Policy
+from rpe.resources import Resource
+from rpe.resources.gcp import GcpStorageBucket
+
+
+class FakeResource(Resource):
+
+    def __init__(self, resource_type='storage.googleapis.com/Bucket', name='my-bucket'):
+        self.resource_type = resource_type
+        self.name = name
+
+    def get(self):
+        self.fetches = getattr(self, 'fetches', 0) + 1
+        return {'type': self.resource_type, 'name': self.name}
+
+    def remediate(self, remediation):
+        pass
+
+    def type(self):
+        return self.resource_type
+
+
+class FakeEngine(Engine):
+
+    def __init__(self, policy_id, delay=0, applies_to=None, revision=None):
+        self.policy_id = policy_id
+        self.delay = delay
+        self.applies_to = applies_to or ['storage.googleapis.com/Bucket']
+        self.calls = 0
+        self._revision = revision
+
+    def revision(self):
+        return self._revision
+
+    def policies(self):
+        return [Policy(policy_id=self.policy_id, engine=self, applies_to=self.applies_to)]
+
+    def evaluate(self, resource):
+        self.calls += 1
+        time.sleep(self.delay)
+
+        if resource.type() not in self.applies_to:
+            return []
+
+        return [Evaluation(
+            resource=resource,
+            engine=self,
+            policy_id=self.policy_id,
+            compliant=True,
+            excluded=False,
+            remediable=False,
+        )]
+
+    def remediate(self, resource, policy_id):
+        pass
+
+
+def make_rpe(engines, **config):
+    rpe = RPE(dict(config, policy_engines=[]))
+    rpe.policy_engines.extend(engines)
+    return rpe
+
+
+def test_rpe_evaluate():
+    rpe = make_rpe([FakeEngine('first'), FakeEngine('second')])
+
+    evals = rpe.evaluate(FakeResource())
+
+    assert [ev.policy_id for ev in evals] == ['first', 'second']
+
+
+def test_rpe_evaluate_snapshot():
+    rpe = make_rpe([FakeEngine('first'), FakeEngine('second')])
+    resource = FakeResource()
+
+    evals = rpe.evaluate(resource)
+
+    # The resource is fetched once, and every engine gets the same snapshot
+    assert resource.fetches == 1
+    assert evals[0].resource is resource
+    assert evals[0].snapshot is evals[1].snapshot
+    assert evals[0].snapshot.get() == {'type': 'storage.googleapis.com/Bucket', 'name': 'my-bucket'}
+
+    # Other attributes are read from the resource
+    assert evals[0].snapshot.name == 'my-bucket'
+
+    with pytest.raises(AttributeError):
+        evals[0].snapshot.name = 'other-bucket'
+
+    # Pickled snapshots keep the data, but not the resource
+    copy = pickle.loads(pickle.dumps(evals[0].snapshot))
+    assert copy.get() == evals[0].snapshot.get()
+    assert copy.origin is None
+
+
+def test_rpe_remediate_then_evaluate(monkeypatch):
+    bucket_data = {'name': 'my-bucket', 'versioning': {'enabled': False}}
+
+    def fake_request(http, uri, method='GET', body=None, headers=None, **kwargs):
+        if method == 'PATCH':
+            bucket_data.update(json.loads(body))
+        return httplib2.Response({'status': 200}), json.dumps(bucket_data).encode('utf-8')
+
+    monkeypatch.setattr(httplib2.Http, 'request', fake_request)
+
+    class VersioningEngine(FakeEngine):
+        def evaluate(self, resource):
+            evals = super().evaluate(resource)
+            for ev in evals:
+                ev.compliant = resource.get()['resource']['versioning']['enabled']
+            return evals
+
+        def remediate(self, resource, policy_id):
+            resource.remediate({'_remediation_spec': 'v2', 'steps': [{
+                'method': 'patch',
+                'params': {'bucket': resource.get()['resource']['name'], 'body': {'versioning': {'enabled': True}}},
+            }]})
+
+    rpe = make_rpe([VersioningEngine('versioning')])
+    bucket = GcpStorageBucket(client_kwargs={'credentials': Credentials(token='')}, name='my-bucket')
+
+    evals = rpe.evaluate(bucket)
+    assert [ev.compliant for ev in evals] == [False]
+
+    evals[0].remediate()
+
+    # The remediated resource is fetched again
+    assert [ev.compliant for ev in rpe.evaluate(bucket)] == [True]
+
+
+def test_rpe_evaluate_unsupported_type():
+    compute = FakeEngine('compute', applies_to=['compute.googleapis.com/Instance'])
+    storage = FakeEngine('storage')
+    rpe = make_rpe([compute, storage])
+
+    # Types without policies aren't fetched or evaluated
+    resource = FakeResource(resource_type='pubsub.googleapis.com/Topic')
+    assert rpe.evaluate(resource) == []
+    assert not hasattr(resource, 'fetches')
+
+    # Only engines with policies for the type evaluate it
+    evals = rpe.evaluate(FakeResource(resource_type='compute.googleapis.com/Instance'))
+    assert [ev.policy_id for ev in evals] == ['compute']
+    assert (compute.calls, storage.calls) == (1, 0)
+
+    compute.applies_to = ['pubsub.googleapis.com/Topic']
+    assert rpe.evaluate(resource) == []
+
+    rpe.refresh_policies()
+    assert [ev.policy_id for ev in rpe.evaluate(resource)] == ['compute']
+
+
+def test_rpe_evaluate_components():
+    class ComponentsEngine(FakeEngine):
+        def __init__(self, policy_id, components):
+            super().__init__(policy_id)
+            self.components = components
+
+        def policies(self):
+            return [Policy(policy_id=self.policy_id, engine=self, applies_to=self.applies_to, components=self.components)]
+
+    class ComponentsResource(FakeResource):
+        def snapshot(self, refresh=False, components=None):
+            self.components = components
+            return super().snapshot(refresh=refresh, components=components)
+
+    resource = ComponentsResource()
+
+    # Only the components used by the policies are fetched
+    make_rpe([ComponentsEngine('none', []), ComponentsEngine('iam', ['iam'])]).evaluate(resource)
+    assert resource.components == {'iam'}
+
+    make_rpe([ComponentsEngine('none', [])]).evaluate(resource)
+    assert resource.components == set()
+
+    # Policies that don't say which components they use get all of them
+    make_rpe([ComponentsEngine('iam', ['iam']), FakeEngine('all')]).evaluate(resource)
+    assert resource.components is None
+
+
+def test_rpe_remediate_twice():
+    class EtagResource(FakeResource):
+        def get(self):
+            return dict(super().get(), etag=self.fetches)
+
+        def remediate(self, remediation):
+            self.remediations = getattr(self, 'remediations', []) + [remediation]
+
+    class EtagEngine(FakeEngine):
+        def remediate(self, resource, policy_id):
+            resource.remediate({'policy_id': policy_id, 'etag': resource.get()['etag']})
+
+    resource = EtagResource()
+    evals = make_rpe([EtagEngine('first'), EtagEngine('second')]).evaluate(resource)
+
+    evals[0].remediate()
+    evals[1].remediate()
+
+    # The second remediation works from the data after the first one
+    assert resource.remediations == [
+        {'policy_id': 'first', 'etag': 1},
+        {'policy_id': 'second', 'etag': 2},
+    ]
+    assert evals[0].snapshot.get()['etag'] == 1
+
+
+@pytest.mark.parametrize("cache_config", [{}, {'path': ':memory:'}], ids=['memory', 'sqlite'])
+def test_rpe_result_cache(cache_config):
+    engine = FakeEngine('policy', revision='1')
+    rpe = make_rpe([engine], result_cache=cache_config)
+
+    first = rpe.evaluate(FakeResource())
+
+    # An unchanged resource is not evaluated again, its results are bound to the new resource
+    resource = FakeResource()
+    evals = rpe.evaluate(resource)
+    assert engine.calls == 1
+    assert evals == [Evaluation(
+        resource=resource,
+        engine=engine,
+        policy_id='policy',
+        compliant=True,
+        excluded=False,
+        remediable=False,
+        snapshot=evals[0].snapshot,
+    )]
+    assert evals[0].snapshot.origin is resource
+    assert first[0].resource is not resource
+
+    # Changes to the resource or the policies are evaluated
+    rpe.evaluate(FakeResource(name='other-bucket'))
+    assert engine.calls == 2
+
+    engine._revision = '2'
+    rpe.evaluate(FakeResource())
+    assert engine.calls == 3
+
+    # Engines without revisions are never cached
+    engine._revision = None
+    rpe.evaluate(FakeResource())
+    rpe.evaluate(FakeResource())
+    assert engine.calls == 5
+
+
+def test_rpe_result_cache_incomplete_results():
+    class FlakyEngine(FakeEngine):
+        def evaluate(self, resource):
+            evals = super().evaluate(resource)
+
+            # Engines drop the evaluations of policies that raised an exception
+            return evals if self.calls > 1 else []
+
+    engine = FlakyEngine('policy', revision='1')
+    rpe = make_rpe([engine], result_cache={}, policy_index_ttl=0)
+
+    assert rpe.evaluate(FakeResource()) == []
+    assert len(rpe.evaluate(FakeResource())) == 1
+    assert len(rpe.evaluate(FakeResource())) == 1
+    assert engine.calls == 2
+
+
+def test_rpe_result_cache_ancestry():
+    class AncestryResource(FakeResource):
+        def __init__(self, ancestry):
+            super().__init__()
+            self.ancestry = ancestry
+
+    engine = FakeEngine('policy', revision='1')
+    rpe = make_rpe([engine], result_cache={})
+
+    rpe.evaluate(AncestryResource(['projects/a', 'organizations/1']))
+    rpe.evaluate(AncestryResource(['projects/a', 'organizations/1']))
+    assert engine.calls == 1
+
+    # Policies can read the ancestry, so resources with the same data in other projects are evaluated
+    rpe.evaluate(AncestryResource(['projects/b', 'organizations/1']))
+    assert engine.calls == 2
+
+
+def test_rpe_result_cache_table(tmp_path):
+    rpe = make_rpe([], result_cache={'path': str(tmp_path / 'cache.db'), 'table': 'evaluations'})
+    assert rpe.result_cache.table == 'evaluations'
+
+    rpe = make_rpe([], result_cache={'path': str(tmp_path / 'cache.db')})
+    assert rpe.result_cache.table == 'results'
+
+
+class BarrierEngine(FakeEngine):
+    ''' Waits for all engines sharing the barrier to be evaluating at once '''
+
+    def __init__(self, policy_id, barrier):
+        super().__init__(policy_id)
+        self.barrier = barrier
+
+    def evaluate(self, resource):
+        self.barrier.wait()
+        return super().evaluate(resource)
+
+
+def test_rpe_evaluate_parallel():
+    barrier = threading.Barrier(3, timeout=5)
+    rpe = make_rpe([BarrierEngine(name, barrier) for name in ['first', 'second', 'third']], parallel_engines=True)
+
+    # The barrier would break if the engines didn't run at the same time
+    evals = rpe.evaluate(FakeResource())
+
+    # Results keep engine order
+    assert [ev.policy_id for ev in evals] == ['first', 'second', 'third']
+
+
+def test_rpe_evaluate_parallel_timeout():
+    rpe = make_rpe([FakeEngine('fast'), FakeEngine('slow', delay=0.5)], parallel_engines=True, engine_timeout=0.1)
+
+    with pytest.raises(EngineTimeout):
+        rpe.evaluate(FakeResource())
+
+
+def test_rpe_evaluate_parallel_timeout_per_engine():
+    rpe = make_rpe([FakeEngine('first', delay=0.4), FakeEngine('second', delay=0.4)], parallel_engines=True, engine_timeout=0.6)
+
+    # With one worker the second engine starts late, but still gets the full timeout
+    rpe._executor = ThreadPoolExecutor(max_workers=1)
+    evals = rpe.evaluate(FakeResource())
+
+    assert [ev.policy_id for ev in evals] == ['first', 'second']
+
+
+def test_rpe_evaluate_parallel_timeout_busy_workers():
+    release = threading.Event()
+
+    class HangingEngine(FakeEngine):
+        def evaluate(self, resource):
+            release.wait()
+            return super().evaluate(resource)
+
+    rpe = make_rpe([FakeEngine('fast'), HangingEngine('hanging')], parallel_engines=True, engine_timeout=0.1)
+    errors = []
+
+    def evaluate_many():
+        # More calls than there are workers, each leaving one hanging
+        for _ in range(12):
+            try:
+                rpe.evaluate(FakeResource())
+            except EngineTimeout as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=evaluate_many)
+    thread.start()
+    thread.join(timeout=10)
+    release.set()
+
+    # Hanging engines don't keep later evaluations from timing out
+    assert not thread.is_alive()
+    assert len(errors) == 12
+
+
+def test_rpe_evaluate_parallel_timeout_not_started():
+    rpe = make_rpe([FakeEngine('first'), FakeEngine('second')], parallel_engines=True, engine_timeout=0.1)
+
+    # Engines waiting for a worker time out too
+    release = threading.Event()
+    rpe._executor = ThreadPoolExecutor(max_workers=1)
+    rpe._executor.submit(release.wait)
+
+    try:
+        with pytest.raises(EngineTimeout):
+            rpe.evaluate(FakeResource())
+    finally:
+        release.set()
+
+
+class BrokenEngine(FakeEngine):
+
+    def evaluate(self, resource):
+        if resource.name == 'broken':
+            raise ValueError('evaluation failed')
+
+        return super().evaluate(resource)
+
+
+def test_rpe_evaluate_stream_ordered():
+    rpe = make_rpe([FakeEngine('policy')])
+    resources = [FakeResource(name=str(i)) for i in range(20)]
+
+    results = list(rpe.evaluate_stream(resources, max_workers=4))
+
+    assert [res for res, _ in results] == resources
+    assert all(evals[0].resource is res for res, evals in results)
+
+
+def test_rpe_evaluate_stream_unordered():
+    rpe = make_rpe([FakeEngine('policy')])
+    resources = [FakeResource(name=str(i)) for i in range(20)]
+
+    results = list(rpe.evaluate_stream(resources, max_workers=4, ordered=False))
+
+    assert sorted(res.name for res, _ in results) == sorted(res.name for res in resources)
+
+
+def test_rpe_evaluate_stream_captures_errors():
+    rpe = make_rpe([BrokenEngine('policy')])
+    resources = [FakeResource(name='ok'), FakeResource(name='broken'), FakeResource(name='also-ok')]
+
+    results = list(rpe.evaluate_stream(resources))
+
+    assert isinstance(results[1][1], ValueError)
+    assert len(results[0][1]) == 1
+    assert len(results[2][1]) == 1
+
+
+def test_rpe_evaluate_stream_bounds_in_flight():
+    rpe = make_rpe([FakeEngine('policy')])
+    consumed = []
+
+    def resources():
+        for i in range(100):
+            consumed.append(i)
+            yield FakeResource(name=str(i))
+
+    stream = rpe.evaluate_stream(resources(), max_workers=2, max_in_flight=5)
+    next(stream)
+
+    assert len(consumed) <= 6
+    stream.close()